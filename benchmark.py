@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""Benchmark the pure Python formatting against the builtin str.format().
+
+It measures the parsing of the templates, the calls to format() and the
+_strformat() function, for the modules stringformat and stringformat_lite.
+The pure Python implementation of stringformat, which _strformat() skips
+for the builtin types, is measured as 'stringformat (emulated)'.
+
+Usage: python benchmark.py [-n NUMBER] [--json FILENAME]
+"""
+
+import optparse
+import platform
+import sys
+import timeit
+
+try:
+    format
+    has_builtin_format = True
+except NameError:   # Python < 2.6
+    has_builtin_format = False
+
+# (name, template, args, kwargs)
+TEMPLATES = [
+    ('literal', 'Hello world', '()', '{}'),
+    ('positional', 'Hello {0}, you are {1} years old', "('Fred', 42)", '{}'),
+    ('keywords', '{name} <{email}>', '()',
+     "dict(name='Fred', email='fred@example.com')"),
+    ('numeric', '{0:>10d}|{1:+.3f}|{2:08.2e}|{3:#x}',
+     '(42, 3.14159, 12345.678, 255)', '{}'),
+    ('thousands', '{0:,d} {1:,.2f}', '(1234567890, -1234567.891)', '{}'),
+    ('nested spec', '{0:{1}.{2}f}|{0:>{1}}', '(3.14159, 10, 2)', '{}'),
+    ('attribute chain', '{0.real.imag} {0.imag.real} {0.real.real}',
+     '(1+2j,)', '{}'),
+    ('item chain', '{0[a][b]} {0[a][c]} {0[d]}',
+     "({'a': {'b': 1, 'c': 2}, 'd': 3},)", '{}'),
+    ('datetime', '{0:%Y-%m-%d %H:%M} in {0.year}',
+     '(datetime.datetime(2010, 9, 7, 12, 30),)', '{}'),
+    ('long', ' '.join(['{%d:>8}' % i for i in range(20)]),
+     'tuple(range(20))', '{}'),
+]
+
+# (format_spec, value)
+SPECS = [
+    ('', "'abc'"),
+    ('>10', "'abc'"),
+    ('.2s', "'abc'"),
+    ('', '42'),
+    ('+08d', '42'),
+    ('#x', '255'),
+    ('c', '65'),
+    ('.3f', '3.14159'),
+    ('e', '12345.678'),
+    ('*^12g', '12345.678'),
+    (',d', '1234567890'),
+    (',', '1234567890'),
+    (',.2f', '-1234567.891'),
+    ('015,.2f', '-1234567.891'),
+    ('020,', '1 << 42'),
+]
+
+MODULES = ['stringformat', 'stringformat_lite']
+
+
+def bench(stmt, setup, number):
+    """Return the best time per loop in microseconds, or None if it fails."""
+    try:
+        exec(setup + '\n' + stmt, {})
+    except Exception:
+        return None
+    timer = timeit.Timer(stmt, setup)
+    return min(timer.repeat(3, number)) * 1e6 / number
+
+
+def bench_templates(number):
+    for name, template, args, kwargs in TEMPLATES:
+        setup = ('import datetime\n'
+                 'fmt = %r\n'
+                 'args, kwargs = %s, %s\n' % (template, args, kwargs))
+        for module in MODULES:
+            module_setup = setup + 'from %s import FormattableString\n' % module
+            yield ('parse', name, module,
+                   bench('FormattableString(fmt)', module_setup, number))
+            module_setup += 'template = FormattableString(fmt)\n'
+            yield ('format', name, module,
+                   bench('template.format(*args, **kwargs)', module_setup,
+                         number))
+            if module == 'stringformat':
+                yield ('format', name, 'stringformat (compiled)',
+                       bench('template.format(*args, **kwargs)',
+                             module_setup + 'template.compile()\n', number))
+        if has_builtin_format:
+            yield ('format', name, 'str.format',
+                   bench('fmt.format(*args, **kwargs)', setup, number))
+
+
+def bench_specs(number):
+    for spec, value in SPECS:
+        name = '%r %s' % (spec, value)
+        for module in MODULES:
+            yield ('_strformat', name, module,
+                   bench('_strformat(%s, %r)' % (value, spec),
+                         'from %s import _strformat' % module, number))
+        yield ('_strformat', name, 'stringformat (emulated)',
+               bench('_emulate_format(%s, spec)' % value,
+                     'from stringformat import _emulate_format, _parse_spec\n'
+                     'spec = _parse_spec(%r)' % spec, number))
+        if has_builtin_format:
+            yield ('_strformat', name, 'format',
+                   bench('format(%s, %r)' % (value, spec), 'pass', number))
+
+
+def main(args):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--number', type='int', default=10000,
+                      help='number of loops per measure [%default]')
+    parser.add_option('--json', metavar='FILENAME',
+                      help='write the results to a JSON file')
+    options, args = parser.parse_args(args)
+
+    results = []
+    print('%-10s %-22s %-24s %10s' % ('group', 'name', 'implementation',
+                                      'usec'))
+    for benchmark in bench_templates, bench_specs:
+        for group, name, implementation, usec in benchmark(options.number):
+            if usec is None:
+                timing = '%10s' % 'n/a'
+            else:
+                timing = '%10.3f' % usec
+            print('%-10s %-22s %-24s %s' % (group, name[:22], implementation,
+                                            timing))
+            results.append({'group': group, 'name': name,
+                            'implementation': implementation, 'usec': usec})
+    if options.json:
+        import json
+        fp = open(options.json, 'w')
+        try:
+            json.dump({'python': platform.python_version(),
+                       'number': options.number,
+                       'results': results}, fp, indent=1, sort_keys=True)
+        finally:
+            fp.close()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
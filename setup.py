@@ -24,6 +24,86 @@ with Python 2.6 also::
         stringformat.init(True)
 
 
+The parsed templates are kept in a LRU cache, which size can be adjusted
+(``None`` for unbounded, ``0`` to disable it)::
+
+    stringformat.init(cache_size=2000)
+    print(stringformat.cache_info())
+
+With ``compiled=True``, the cached templates are compiled to Python code,
+like ``FormattableString(template).compile()`` does.
+
+A custom formatter can be registered for a type and its subclasses,
+which is useful when ``__format__`` is not supported (Python < 2.6)::
+
+    stringformat.register_formatter(Decimal, format_decimal)
+
+A ``TemplateRegistry`` keeps compiled templates which can be shared
+between threads, without taking a lock on lookup::
+
+    registry = stringformat.TemplateRegistry()
+    registry.format('{0} <{1}>', name, email)
+
+Large catalogs of templates, like translations, use less memory with
+``intern_template(format_string)``: the equal templates are the same
+instance, and the equal chunks and fields are shared between templates.
+``memory_report(format_strings)`` compares the bytes per template.
+With ``FormattableString(format_string, lazy=True)``, the template is
+parsed on the first call of ``format()`` or ``compile()``, so the unused
+templates of a catalog cost only their format string.
+
+The parsed template can be inspected: ``fields()`` lists the replacement
+fields with their access path, conversion and format specifier,
+``required_args()`` returns the number of positional arguments and the
+names of the keyword arguments, and ``literal_length()`` is the minimum
+length of the result::
+
+    >>> FormattableString('{0.name:>{width}}: {1!r}').required_args()
+    (2, ['width'])
+
+With asyncio, ``aformat()`` resolves the awaitable arguments, attributes
+and items concurrently, and returns a future::
+
+    text = await FormattableString('{0.user.name}: {1}').aformat(req, count)
+
+The templates can be pickled.  ``format_parallel(rows)`` formats large
+batches of rows in a pool of processes, and yields the results in order.
+For large reports, ``write_many(fp, rows)`` joins the results in blocks
+and writes each block at once.  The number of rows per block comes from
+``min_length()``, the widths of the format specifiers plus the literal
+text::
+
+    FormattableString('{0:>12}{1:<30}{2:^8.2f}\\n').write_many(fp, rows)
+
+The profiling mode records the calls, the failures and the timings of
+each template, for ``FormattableString.format`` and the patched
+``str.format``::
+
+    stringformat.enable_profiling()
+    ...
+    for stats in stringformat.profile_stats(10):
+        print(stats)
+
+For logging, ``BraceMessage`` is formatted only when the record is
+emitted, and ``BraceFormatter`` uses the ``'{'`` style for the format
+of the handler.  With ``brace_messages=True``, the messages with arguments
+use the ``'{'`` style too, instead of the ``'%'`` style::
+
+    handler.setFormatter(BraceFormatter('{asctime} {levelname}: {message}'))
+    log.debug(BraceMessage('{0} items', count))
+
+``BytesFormatter`` formats a template to bytes with one encoding
+policy, and it can append the result to a ``bytearray``::
+
+    line = BytesFormatter('{0} {1}\\r\\n', 'utf-8')
+    line.format_into(buffer, command, arg)
+
+The templates of a source tree can be checked and saved at build time,
+and loaded at startup with ``load_templates()``::
+
+    python -m stringformat -o templates.bin src/
+
+
 The advanced string formatting is officially included in the language
 since Python 2.6.
 
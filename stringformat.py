@@ -6,9 +6,28 @@ An implementation of the advanced string formatting (PEP 3101).
 Author: Florent Xicluna
 """
 
+import keyword
+import logging
+import marshal
+import operator
 import re
+import sys
+import time
 
-__all__ = ['FormattableString', 'init']
+try:
+    import threading
+except ImportError:     # Python built without threads
+    import dummy_threading as threading
+
+__all__ = ['FormattableString', 'TemplateRegistry', 'BytesFormatter',
+           'BraceMessage', 'BraceFormatter', 'init', 'cache_info',
+           'cache_clear', 'save_templates', 'load_templates',
+           'register_formatter', 'enable_profiling', 'disable_profiling',
+           'profile_stats', 'profile_clear', 'precompile', 'intern_template',
+           'intern_clear', 'memory_report']
+
+# Default number of templates kept by the cache of str.format
+DEFAULT_CACHE_SIZE = 512
 
 if hasattr(str, 'partition'):
     def partition(s, sep):
@@ -21,13 +40,6 @@ else:   # Python 2.4
             return s, '', ''
         return left, sep, right
 
-_format_str_re = re.compile(
-    r'(%)'                                  # '%'
-    r'|((?<!{)(?:{{)+'                      # '{{'
-    r'|(?:}})+(?!})'                        # '}}
-    r'|{(?:[^{](?:[^{}]+|{[^{}]*})*)?})'    # replacement field
-)
-_format_sub_re = re.compile(r'({[^{}]*})')  # nested replacement field
 _format_spec_re = re.compile(
     r'((?:[^{}]?[<>=^])?)'      # alignment
     r'([-+ ]?)'                 # sign
@@ -35,20 +47,14 @@ _format_spec_re = re.compile(
     r'((?:\.\d+)?)'             # precision
     r'(.?)$'                    # type
 )
+_brace_re = re.compile(r'[{}]')         # in the format string
 _field_part_re = re.compile(
     r'(?:(\[)|\.|^)'            # start or '.' or '['
     r'((?(1)[^]]*|[^.[]*))'     # part
     r'(?(1)(?:\]|$)([^.[]+)?)'  # ']' and invalid tail
 )
-
-if hasattr(re, '__version__'):
-    _format_str_sub = _format_str_re.sub
-else:
-    # Python 2.4 fails to preserve the Unicode type
-    def _format_str_sub(repl, s):
-        if isinstance(s, unicode):
-            return unicode(_format_str_re.sub(repl, s))
-        return _format_str_re.sub(repl, s)
+_identifier_re = re.compile(r'[A-Za-z_][A-Za-z0-9_]*\Z')
+_index_re = re.compile(r'(?:0|[1-9][0-9]*)\Z')    # positional argument
 
 if hasattr(int, '__index__'):
     def _is_integer(value):
@@ -61,25 +67,142 @@ try:
     unicode
     def _chr(n):
         return chr(n % 256)
+    # the results of the str templates are encoded to bytes
+    _byte_strings = str
 except NameError:   # Python 3
     unicode = str
     _chr = chr
+    _byte_strings = ()
+
+
+# Capabilities of the builtin format(), probed once
+try:
+    _native_format = format
+except NameError:   # Python < 2.6
+    _native_format = None
+    _native_comma = False
+else:
+    try:
+        _native_comma = format(1234, ',') == '1,234'
+    except ValueError:  # Python 2.6
+        _native_comma = False
+
+try:
+    _native_types = (int, long, float, str, unicode)
+except NameError:   # Python 3
+    _native_types = (int, float, str)
+
+
+class _FormatSpec(object):
+    """Parsed format specification.
+
+    The attributes are set once by the constructor and never modified, so
+    the instances are shared between the templates.  If the specification
+    does not match the Format Specification Mini-Language, the attribute
+    width is None: it is still usable with the method __format__ or strftime.
+    The attribute native is true if the builtin format() supports it.
+    """
+
+    __slots__ = ('format_spec', 'fill', 'align', 'sign', 'prefix', 'zero',
+                 'width', 'comma', 'precision', 'type', 'native')
+
+    def __init__(self, format_spec):
+        self.format_spec = format_spec
+        m = _format_spec_re.match(format_spec)
+        if not m:
+            self.width = None
+            self.native = False
+            return
+        (align, self.sign, self.prefix, width, self.comma,
+         self.precision, self.type) = m.groups()
+        self.zero = width[:1] == '0'
+        self.width = width and int(width) or 0
+        self.fill, self.align = align[:-1], align[-1:]
+        if not self.fill:
+            self.fill = self.zero and '0' or ' '
+        self.native = bool(_native_format and (_native_comma or
+                                               not self.comma))
+
+_spec_cache = {}
+_SPEC_CACHE_SIZE = 1000
+
+
+def _parse_spec(format_spec):
+    """Return the _FormatSpec for this format_spec, from a bounded memo."""
+    key = (format_spec, type(format_spec))
+    try:
+        return _spec_cache[key]
+    except KeyError:
+        pass
+    if len(_spec_cache) >= _SPEC_CACHE_SIZE:
+        _spec_cache.clear()
+    spec = _spec_cache[key] = _FormatSpec(format_spec)
+    return spec
+
+
+_no_comma_types = set('nsbcoxX')
+
+
+def _group_thousands(rv, width=0):
+    """Insert the thousands separators in the integral part of rv.
+
+    If width is set, the integral part is padded with zeros and separators,
+    to get at least width characters.
+    """
+    start = int(rv[:1] in ('-', '+', ' '))
+    end = start
+    while end < len(rv) and rv[end].isdigit():
+        end += 1
+    digits = rv[start:end]
+    if not digits:
+        # 'inf' or 'nan'
+        return rv
+    if width:
+        width -= len(rv) - len(digits)
+        length = len(digits)
+        while length + (length - 1) // 3 < width:
+            length += 1
+        digits = digits.rjust(length, '0')
+    head = len(digits) % 3 or 3
+    groups = [digits[:head]]
+    groups.extend([digits[i:i + 3] for i in range(head, len(digits), 3)])
+    return rv[:start] + ','.join(groups) + rv[end:]
 
 
 def _strformat(value, format_spec=""):
     """Internal string formatter.
 
-    It implements the Format Specification Mini-Language.
+    It implements the Format Specification Mini-Language.  The builtin
+    types are formatted with the builtin format(), if it supports the
+    specification.
     """
-    m = _format_spec_re.match(str(format_spec))
-    if not m:
+    if not isinstance(format_spec, _FormatSpec):
+        format_spec = _parse_spec(format_spec)
+    if format_spec.native and type(value) in _native_types:
+        return _native_format(value, format_spec.format_spec)
+    return _emulate_format(value, format_spec)
+
+
+def _emulate_format(value, format_spec):
+    """Pure Python implementation of the Format Specification Mini-Language.
+
+    The argument format_spec is a _FormatSpec.
+    """
+    width = format_spec.width
+    if width is None:
         raise ValueError('Invalid conversion specification')
-    align, sign, prefix, width, comma, precision, conversion = m.groups()
+    align = format_spec.align
+    sign = format_spec.sign
+    prefix = format_spec.prefix
+    conversion = format_spec.type
     is_numeric = hasattr(value, '__float__')
     is_integer = is_numeric and _is_integer(value)
     if prefix and not is_integer:
         raise ValueError('Alternate form (#) not allowed in %s format '
                          'specifier' % (is_numeric and 'float' or 'string'))
+    comma = format_spec.comma
+    if comma and (not is_numeric or conversion in _no_comma_types):
+        raise ValueError("Cannot specify ',' with '%s'." % (conversion or 's'))
     if is_numeric and conversion == 'n':
         # Default to 'd' for ints and 'g' for floats
         conversion = is_integer and 'd' or 'g'
@@ -89,9 +212,6 @@ def _strformat(value, format_spec=""):
         if conversion == 'c':
             raise ValueError("Sign not allowed with integer "
                              "format specifier 'c'")
-    if comma:
-        # TODO: thousand separator
-        pass
     try:
         if ((is_numeric and conversion == 's') or
             (not is_integer and conversion in set('cdoxX'))):
@@ -99,28 +219,28 @@ def _strformat(value, format_spec=""):
         if conversion == 'c':
             conversion = 's'
             value = _chr(value)
-        rv = ('%' + prefix + precision + (conversion or 's')) % (value,)
+        rv = ('%' + prefix + format_spec.precision +
+              (conversion or 's')) % (value,)
     except ValueError:
         raise ValueError("Unknown format code %r for object of type %r" %
                          (conversion, value.__class__.__name__))
     if sign not in '-' and value >= 0:
         # sign in (' ', '+')
         rv = sign + rv
-    if width:
-        zero = (width[0] == '0')
-        width = int(width)
-    else:
-        zero = False
-        width = 0
+    zero = format_spec.zero
+    if comma:
+        # zero padding is grouped too
+        if format_spec.fill == '0' and (align == '=' or (zero and not align)):
+            rv = _group_thousands(rv, width)
+        else:
+            rv = _group_thousands(rv)
     # Fastpath when alignment is not required
     if width <= len(rv):
         if not is_numeric and (align == '=' or (zero and not align)):
             raise ValueError("'=' alignment not allowed in string format "
                              "specifier")
         return rv
-    fill, align = align[:-1], align[-1:]
-    if not fill:
-        fill = zero and '0' or ' '
+    fill = format_spec.fill
     if align == '^':
         padding = width - len(rv)
         # tweak the formatting if the padding is odd
@@ -143,136 +263,1831 @@ def _strformat(value, format_spec=""):
     return rv
 
 
-def _format_field(value, parts, conv, spec, want_bytes=False):
-    """Format a replacement field."""
-    for k, part, _ in parts:
-        if k:
-            if part.isdigit():
-                value = value[int(part)]
+def _access_expr(expr, parts, const):
+    """Return the Python expression which looks up the parts in expr.
+
+    The function const(value) returns the name bound to a constant.
+    """
+    for k, part in parts:
+        if not k:
+            if _identifier_re.match(part) and not keyword.iskeyword(part):
+                expr = '%s.%s' % (expr, part)
             else:
-                value = value[part]
+                expr = 'getattr(%s, %s)' % (expr, const(part))
+        elif isinstance(part, int):
+            expr = '%s[%d]' % (expr, part)
         else:
-            value = getattr(value, part)
-    if conv:
-        value = ((conv == 'r') and '%r' or '%s') % (value,)
+            expr = '%s[%s]' % (expr, const(part))
+    return expr
+
+
+def _make_getter(parts):
+    """Return a callable which looks up the parts, or None if empty."""
+    if not parts:
+        return None
+    if len(parts) == 1:
+        k, part = parts[0]
+        return (k and operator.itemgetter or operator.attrgetter)(part)
+    try:
+        return _getter_cache[parts]
+    except KeyError:
+        pass
+    if _dotted_attrgetter and not [k for (k, part) in parts if k]:
+        getter = operator.attrgetter('.'.join([part for (k, part) in parts]))
+    else:
+        getters = tuple([_make_getter((part,)) for part in parts])
+
+        def getter(value):
+            for get in getters:
+                value = get(value)
+            return value
+    if len(_getter_cache) >= _GETTER_CACHE_SIZE:
+        _getter_cache.clear()
+    _getter_cache[parts] = getter
+    return getter
+
+_getter_cache = {}
+_GETTER_CACHE_SIZE = 1000
+try:
+    _dotted_attrgetter = operator.attrgetter('real.real')(1) == 1
+except AttributeError:  # Python < 2.6
+    _dotted_attrgetter = False
+
+
+def _field_tree(items):
+    """Build the prefix tree of the field paths.
+
+    Each node is a tuple (parts, getter, items, children), where parts is
+    the path from the parent node, and items are the fields which end on
+    this node.  The chains of nodes without fields are merged.
+    """
+    if len(items) == 1:
+        item = items[0]
+        return (item[0], item[1], items, ())
+    root = ({}, [])
+    for item in items:
+        node = root
+        for part in item[0]:
+            node = node[0].setdefault(part, ({}, []))
+        node[1].append(item)
+
+    def compress(parts, node):
+        children, node_items = node
+        while not node_items and len(children) == 1:
+            ((part, node),) = children.items()
+            parts += (part,)
+            children, node_items = node
+        return (parts, _make_getter(parts), tuple(node_items),
+                tuple([compress((part,), child)
+                       for (part, child) in children.items()]))
+    return compress((), root)
+
+
+def _format_value(value, format_spec):
+    """Format a value, looking up its methods on each call."""
     if hasattr(value, '__format__'):
-        value = value.__format__(spec)
-    elif hasattr(value, 'strftime') and spec:
-        value = value.strftime(str(spec))
+        return value.__format__(format_spec)
+    if hasattr(value, 'strftime') and format_spec:
+        return value.strftime(str(format_spec))
+    return _strformat(value, format_spec)
+
+
+def _format_date(value, format_spec):
+    if format_spec:
+        return value.strftime(str(format_spec))
+    return _strformat(value, format_spec)
+
+
+def _format_builtin(value, format_spec):
+    # str, unicode and numbers, before Python 2.6
+    if format_spec:
+        return _strformat(value, format_spec)
+    return '%s' % (value,)
+
+
+def _make_formatter(cls):
+    """Return the formatter function for the instances of cls."""
+    for base in getattr(cls, '__mro__', ()):
+        if base in _registered_formatters:
+            return _registered_formatters[base]
+    if hasattr(cls, '__format__'):
+        return cls.__format__
+    if hasattr(cls, 'strftime'):
+        return _format_date
+    if cls in _builtin_types:
+        return _format_builtin
+    return _strformat
+
+try:
+    _builtin_types = (str, unicode, int, long, float)
+except NameError:   # Python 3
+    _builtin_types = (str, int, float)
+
+try:
+    from types import InstanceType as _InstanceType
+except ImportError:     # Python 3
+    _InstanceType = None
+
+# The formatter functions, keyed by type(value)
+_formatters = {_InstanceType: _format_value}
+_registered_formatters = {}
+_FORMATTERS_SIZE = 1000
+
+
+def register_formatter(cls, formatter):
+    """Register the function which formats the instances of cls.
+
+    The function is called as formatter(value, format_spec) and returns
+    the formatted string.  It is used for the subclasses of cls too.  If
+    formatter is None, the registration is removed.
+    """
+    if formatter is None:
+        _registered_formatters.pop(cls, None)
     else:
-        value = _strformat(value, spec)
+        _registered_formatters[cls] = formatter
+    _formatters.clear()
+    _formatters[_InstanceType] = _format_value
+
+
+def _format_field(value, getter, conv, spec, want_bytes=False):
+    """Format a replacement field."""
+    if getter is not None:
+        value = getter(value)
+    if conv:
+        value = ((conv == 'r') and '%r' or '%s') % (value,)
+    cls = type(value)
+    try:
+        formatter = _formatters[cls]
+    except KeyError:
+        if len(_formatters) >= _FORMATTERS_SIZE:
+            _formatters.clear()
+            _formatters[_InstanceType] = _format_value
+        formatter = _formatters[cls] = _make_formatter(cls)
+    value = formatter(value, spec.format_spec)
     if want_bytes and isinstance(value, unicode):
         return str(value)
     return value
 
 
-class FormattableString(object):
-    """Class which implements method format().
+# Longest field path which is inlined in the generated code
+_MAX_INLINE_PARTS = 20
 
-    The method format() behaves like str.format() in python 2.6+.
 
-    >>> FormattableString(u'{a:5}').format(a=42)
-    ... # Same as u'{a:5}'.format(a=42)
-    u'   42'
+def _codegen(fs):
+    """Generate a Python function which formats the FormattableString.
 
+    The function is called with (args, kwargs).  The literal chunks, the
+    keys and the format specifications are bound as a default argument.
     """
+    slots = fs._slots
+    consts = {'_field': _format_field, '_join': fs.format_string[:0].join,
+              '_spec': _parse_spec,
+              '_want_bytes': isinstance(fs.format_string, _byte_strings)}
+    lines = []
+    names = {}
+    values = {}
+    fields = {}
 
-    __slots__ = '_index', '_kwords', '_nested', '_string', 'format_string'
+    def const(value):
+        var = '_c%d' % len(consts)
+        consts[var] = value
+        return var
 
-    def __init__(self, format_string):
-        self._index = 0
-        self._kwords = {}
-        self._nested = {}
+    def argument(name):
+        if name not in names:
+            var = names[name] = 'a%d' % len(names)
+            if _index_re.match(name):
+                lines.append('if len(args) > %d:' % int(name))
+                lines.append('    %s = args[%d]' % (var, int(name)))
+                lines.append('else:')
+                lines.append('    %s = kwargs[%s]' % (var, const(name)))
+            else:
+                lines.append('%s = kwargs[%s]' % (var, const(name)))
+        return names[name]
 
-        self.format_string = format_string
-        self._string = _format_str_sub(self._prepare, format_string)
+    def access(expr, parts, getter):
+        # the long paths are looked up by the getter, within the nesting
+        # limits of the compiler
+        if len(parts) > _MAX_INLINE_PARTS:
+            return '%s(%s)' % (const(getter), expr)
+        return _access_expr(expr, parts, const)
 
-    def __eq__(self, other):
-        if isinstance(other, FormattableString):
-            return self.format_string == other.format_string
-        # Compare equal with the original string.
-        return self.format_string == other
+    def lookup(expr, node):
+        # Assign the common prefixes of the field paths to variables
+        parts, getter, node_items, children = node
+        expr = access(expr, parts, getter)
+        if parts and len(node_items) + len(children) > 1:
+            var = 't%d' % len(lines)
+            lines.append('%s = %s' % (var, expr))
+            expr = var
+        for item in node_items:
+            values[item[4]] = expr
+        for child in children:
+            lookup(expr, child)
 
-    def _prepare(self, match):
-        # Called for each replacement field.
-        part = match.group(0)
-        if part == '%':
-            return '%%'
-        if part[0] == part[-1]:
-            # '{{' or '}}'
-            assert part == part[0] * len(part)
-            return part[:len(part) // 2]
-        repl = part[1:-1]
+    def chunk(slot):
+        # Return the expression of a slot
+        if not isinstance(slots[slot], tuple):
+            return const(slots[slot])
+        if slot in fields:
+            return fields[slot]
+        name, (parts, getter, conv, spec, _) = slots[slot]
+        if slot in values:
+            expr = values[slot]
+        else:
+            expr = access(argument(name), parts, getter)
+        if isinstance(spec, _FormatSpec):
+            spec = const(spec)
+        else:
+            # computed format specifier
+            spec = '_spec(_join((%s,)))' % ', '.join([chunk(i) for i in spec])
+        var = fields[slot] = 'f%d' % len(lines)
+        lines.append('%s = _field(%s, None, %s, %s, _want_bytes)' %
+                     (var, expr, const(conv), spec))
+        return var
+
+    for name, node in fs._tree:
+        lookup(argument(name), node)
+    pieces = [chunk(slot) for slot in fs._chunks]
+    if pieces:
+        lines.append('return _join((%s,))' % ', '.join(pieces))
+    else:
+        lines.append('return %s' % const(fs.format_string))
+    # one default argument: a function has at most 255 arguments before
+    # Python 3.7; the constants are unpacked into fast local variables
+    names = sorted(consts)
+    source = 'def _format(args, kwargs, _consts=_consts):\n    %s\n' % (
+        '\n    '.join(['(%s,) = _consts' % ', '.join(names)] + lines))
+    namespace = {'_consts': tuple([consts[var] for var in names])}
+    exec(compile(source, '<stringformat>', 'exec'), namespace)
+    return namespace['_format']
+
+
+class _Parser(object):
+    """Single-pass parser of the format strings.
+
+    It scans the format string once, and it splits it in slots: the literal
+    chunks and the replacement fields.  The same literal or field is stored
+    in one slot.
+    """
+
+    __slots__ = 'fields', 'index', 'literals', 'slots'
+
+    def __init__(self):
+        self.fields = {}
+        self.index = 0
+        self.literals = {}
+        # literal chunks and (name, item) pairs
+        self.slots = []
+
+    def parse(self, format_string):
+        """Return the list of the slots of the format string, in order."""
+        s = format_string
+        join = s[:0].join
+        chunks = []
+        pieces = []
+        append = pieces.append
+        pos, length = 0, len(s)
+        while True:
+            m = _brace_re.search(s, pos)
+            if m is None:
+                append(s[pos:])
+                break
+            i = m.start()
+            if i > pos:
+                append(s[pos:i])
+            pos = i + 1
+            if s[i] == '}':
+                # '}}' is an escaped '}', a single '}' is left unchanged
+                while pos < length and s[pos] == '}':
+                    pos += 1
+                if (pos - i) % 2:
+                    pos = i + 1
+                    append('}')
+                else:
+                    append('}' * ((pos - i) // 2))
+            elif s[pos:pos + 1] == '{' and (i == 0 or s[i - 1] != '{'):
+                # '{{' is an escaped '{'
+                while pos < length and s[pos] == '{':
+                    pos += 1
+                pos = i + (pos - i) // 2 * 2
+                append('{' * ((pos - i) // 2))
+            else:
+                end = _field_end(s, i)
+                if end < 0:
+                    # not a replacement field
+                    append('{')
+                else:
+                    if pieces:
+                        chunks.append(self.literal(join(pieces)))
+                        del pieces[:]
+                    chunks.append(self.field(s[pos:end - 1]))
+                    pos = end
+        literal = join(pieces)
+        if literal:
+            chunks.append(self.literal(literal))
+        return chunks
+
+    def nested_spec(self, format_spec):
+        """Return the tuple of the slots of a computed format specifier."""
+        s = format_spec
+        chunks = []
+        literal = s[:0]
+        pos = 0
+        while True:
+            i = s.find('{', pos)
+            if i < 0:
+                break
+            m = _brace_re.search(s, i + 1)
+            if m is None:
+                break
+            end = m.start()
+            if s[end] == '}':
+                literal += s[pos:i]
+                if literal:
+                    chunks.append(self.literal(literal))
+                    literal = s[:0]
+                chunks.append(self.field(s[i + 1:end]))
+                pos = end + 1
+            else:
+                literal += s[pos:end]
+                pos = end
+        literal += s[pos:]
+        if literal:
+            chunks.append(self.literal(literal))
+        return tuple(chunks)
+
+    def literal(self, text):
+        """Return the slot of a literal chunk."""
+        try:
+            return self.literals[text]
+        except KeyError:
+            slot = self.literals[text] = len(self.slots)
+            self.slots.append(text)
+            return slot
+
+    def field(self, repl):
+        """Register a replacement field, and return its slot."""
         field, _, format_spec = partition(repl, ':')
-        literal, sep, conversion = partition(field, '!')
-        if sep and not conversion:
-            raise ValueError("end of format while looking for "
-                             "conversion specifier")
-        if len(conversion) > 1:
-            raise ValueError("expected ':' after format specifier")
-        if conversion not in 'rsa':
-            raise ValueError("Unknown conversion specifier %s" %
-                             str(conversion))
-        name_parts = _field_part_re.findall(literal)
+        if '!' in field:
+            literal, sep, conversion = partition(field, '!')
+            if not conversion:
+                raise ValueError("end of format while looking for "
+                                 "conversion specifier")
+            if len(conversion) > 1:
+                raise ValueError("expected ':' after format specifier")
+            if conversion not in 'rsa':
+                raise ValueError("Unknown conversion specifier %s" %
+                                 str(conversion))
+        else:
+            literal, conversion = field, ''
+        if '.' in literal or '[' in literal:
+            name_parts = _split_field_name(literal)
+        else:
+            # only the argument name
+            name_parts = [('', literal, '')]
         if literal[:1] in '.[':
             # Auto-numbering
-            if self._index is None:
+            if self.index is None:
                 raise ValueError("cannot switch from manual field "
                                  "specification to automatic field numbering")
-            name = str(self._index)
-            self._index += 1
+            name = str(self.index)
+            self.index += 1
             if not literal:
                 del name_parts[0]
         else:
             name = name_parts.pop(0)[1]
-            if name.isdigit() and self._index is not None:
+            if name.isdigit() and self.index is not None:
                 # Manual specification
-                if self._index:
+                if self.index:
                     raise ValueError("cannot switch from automatic field "
                                      "numbering to manual field specification")
-                self._index = None
-        empty_attribute = False
-        for k, v, tail in name_parts:
-            if not v:
-                empty_attribute = True
-            if tail:
-                raise ValueError("Only '.' or '[' may follow ']' "
-                                 "in format field specifier")
-        if name_parts and k == '[' and not literal[-1] == ']':
-            raise ValueError("Missing ']' in format string")
-        if empty_attribute:
-            raise ValueError("Empty attribute in format string")
-        if '{' in format_spec:
-            format_spec = _format_sub_re.sub(self._prepare, format_spec)
-            rv = (name_parts, conversion, format_spec)
-            self._nested.setdefault(name, []).append(rv)
+                self.index = None
+        parts = ()
+        if name_parts:
+            empty_attribute = False
+            for k, v, tail in name_parts:
+                if not v:
+                    empty_attribute = True
+                if tail:
+                    raise ValueError("Only '.' or '[' may follow ']' "
+                                     "in format field specifier")
+            if k == '[' and not literal[-1] == ']':
+                raise ValueError("Missing ']' in format string")
+            if empty_attribute:
+                raise ValueError("Empty attribute in format string")
+            parts = []
+            for k, v, _ in name_parts:
+                if k and v.isdigit():
+                    v = int(v)
+                parts.append((k, v))
+            parts = tuple(parts)
+        nested = '{' in format_spec
+        if nested:
+            format_spec = self.nested_spec(format_spec)
+        key = (name, parts, conversion, format_spec)
+        try:
+            # same field, formatted once
+            return self.fields[key]
+        except KeyError:
+            pass
+        if not nested:
+            format_spec = _parse_spec(format_spec)
+        slot = self.fields[key] = len(self.slots)
+        self.slots.append((name, (parts, _make_getter(parts), conversion,
+                                  format_spec, slot)))
+        return slot
+
+
+def _set_fields(fs, slots):
+    """Set the slots and the fields of the FormattableString.
+
+    The prefix trees of the fields are built on first use, from the slots.
+    """
+    fs._slots = tuple(slots)
+    fs._nested = tuple([value for value in fs._slots
+                        if isinstance(value, tuple) and
+                        not isinstance(value[1][3], _FormatSpec)])
+
+
+def _field_trees(slots):
+    """Return the tuple of (name, tree) of the fields with a static format
+    specifier, in the order of the names.
+    """
+    names = []
+    kwords = {}
+    for value in slots:
+        if isinstance(value, tuple) and isinstance(value[1][3], _FormatSpec):
+            name, item = value
+            try:
+                kwords[name].append(item)
+            except KeyError:
+                kwords[name] = [item]
+                names.append(name)
+    return tuple([(name, _field_tree(tuple(kwords[name]))) for name in names])
+
+
+def _field_info(slots, slot):
+    """Return the tuple (name, path, conversion, format_spec) of a field."""
+    name, (parts, getter, conv, spec, _) = slots[slot]
+    path = tuple([(k or '.', part) for (k, part) in parts])
+    if isinstance(spec, _FormatSpec):
+        spec = spec.format_spec
+    else:
+        spec = name[:0].join([_field_text(slots, i) for i in spec])
+    return (name, path, conv or None, spec)
+
+
+def _field_text(slots, slot):
+    # Return the literal chunk, or the replacement field as written
+    if not isinstance(slots[slot], tuple):
+        return slots[slot]
+    name, path, conv, spec = _field_info(slots, slot)
+    text = [name]
+    for k, part in path:
+        if k == '.':
+            text.append('.%s' % part)
         else:
-            rv = (name_parts, conversion, format_spec)
-            self._kwords.setdefault(name, []).append(rv)
-        return r'%%(%s)s' % id(rv)
+            text.append('[%s]' % part)
+    if conv:
+        text.append('!' + conv)
+    if spec:
+        text.append(':' + spec)
+    return '{%s}' % ''.join(text)
+
+
+def _field_end(s, start):
+    """Return the end of the replacement field at s[start], or -1.
+
+    The field contains one level of nested replacement fields.
+    """
+    pos = start + 1
+    if s[pos:pos + 1] not in ('', '{'):
+        pos += 1
+        while True:
+            m = _brace_re.search(s, pos)
+            if m is None:
+                break
+            pos = m.start()
+            if s[pos] == '}':
+                return pos + 1
+            m = _brace_re.search(s, pos + 1)
+            if m is None or s[m.start()] == '{':
+                break
+            pos = m.end()
+    if s[start + 1:start + 2] == '}':
+        # empty field name
+        return start + 2
+    return -1
+
+
+def _split_field_name(literal):
+    """Split the field name in a list of (k, part, tail).
+
+    The first item is the argument name, the next ones are attributes
+    (k = '') or keys (k = '[').  The tail is the text between ']' and the
+    next '.' or '[', which is invalid.
+    """
+    return _field_part_re.findall(literal)
+
+
+# Serialize the parsing of the lazy templates
+_parse_lock = threading.Lock()
+
+
+class FormattableString(object):
+    """Class which implements method format().
+
+    The method format() behaves like str.format() in python 2.6+.
+
+    >>> FormattableString(u'{a:5}').format(a=42)
+    ... # Same as u'{a:5}'.format(a=42)
+    u'   42'
+
+    With lazy=True, the format string is parsed on first use, by format()
+    or compile(), and the syntax errors are raised there.
+    """
+
+    __slots__ = ('_chunks', '_func', '_nested', '_slots', '_tree',
+                 'format_string')
+
+    def __init__(self, format_string, lazy=False):
+        self._func = None
+        self.format_string = format_string
+        if not lazy:
+            self._parse()
+
+    def __getattr__(self, name):
+        # Only called for the attributes not set yet: by a lazy template,
+        # and for the prefix trees, which are built on first use
+        if name not in ('_chunks', '_nested', '_slots', '_tree'):
+            raise AttributeError(name)
+        _parse_lock.acquire()
+        try:
+            try:
+                return object.__getattribute__(self, name)
+            except AttributeError:
+                pass
+            try:
+                slots = object.__getattribute__(self, '_slots')
+            except AttributeError:
+                self._parse()
+                slots = self._slots
+            if name == '_tree':
+                self._tree = _field_trees(slots)
+            return object.__getattribute__(self, name)
+        finally:
+            _parse_lock.release()
+
+    def _parse(self):
+        parser = _Parser()
+        self._chunks = tuple(parser.parse(self.format_string))
+        _set_fields(self, parser.slots)
+
+    def __eq__(self, other):
+        if isinstance(other, FormattableString):
+            return self.format_string == other.format_string
+        # Compare equal with the original string.
+        return self.format_string == other
+
+    def __getstate__(self):
+        # the id() of the fields are replaced by indexes
+        return (_dump_state(self), self._func is not None)
+
+    def __setstate__(self, state):
+        state, compiled = state
+        _load_state(state, self)
+        if compiled:
+            self.compile()
+
+    def compile(self):
+        """Compile the template into a specialized Python function.
+
+        Subsequent calls to format() run the generated code, which skips the
+        building of the parameters and the '%' operation.  Return self.
+        """
+        if self._func is None:
+            self._func = _codegen(self)
+        return self
+
+    def fields(self):
+        """Return the list of the replacement fields.
+
+        Each field is a tuple (name, path, conversion, format_spec), where
+        path is a tuple of ('.', attribute) and ('[', key) pairs, and
+        conversion is None or one of 'r', 's' and 'a'.  A computed format
+        specifier is returned as written, with the nested fields numbered.
+        A field which is repeated is listed once, and the fields of a
+        computed format specifier come before it.
+        """
+        return [_field_info(self._slots, slot) for slot in
+                range(len(self._slots)) if isinstance(self._slots[slot], tuple)]
+
+    def required_args(self):
+        """Return the arguments required by format(), as (count, names).
+
+        The count is the number of positional arguments, and names is the
+        sorted list of the keyword arguments.
+        """
+        count = 0
+        names = set()
+        for name, item in self._items():
+            if _index_re.match(name):
+                count = max(count, int(name) + 1)
+            else:
+                names.add(name)
+        return count, sorted(names)
+
+    def literal_length(self):
+        """Return the length of the literal text of the result.
+
+        This is the minimum length of the result of format().
+        """
+        slots = self._slots
+        return sum([len(slots[i]) for i in self._chunks
+                    if not isinstance(slots[i], tuple)])
+
+    def min_length(self):
+        """Return the static minimum length of the result of format().
+
+        The widths of the format specifiers are added to literal_length().
+        This is an estimate: the types with their own __format__ method,
+        like the dates, may ignore the width.
+        """
+        slots = self._slots
+        length = 0
+        for i in self._chunks:
+            value = slots[i]
+            if not isinstance(value, tuple):
+                length += len(value)
+            elif isinstance(value[1][3], _FormatSpec) and value[1][3].width:
+                length += value[1][3].width
+        return length
 
     def format(self, *args, **kwargs):
         """Same as str.format() and unicode.format() in Python 2.6+."""
+        if self._func is not None:
+            return self._func(args, kwargs)
         if args:
             kwargs.update(dict((str(i), value)
                                for (i, value) in enumerate(args)))
         # Encode arguments to ASCII, if format string is bytes
-        want_bytes = isinstance(self._string, str)
-        params = {}
-        for name, items in self._kwords.items():
-            value = kwargs[name]
-            for item in items:
-                parts, conv, spec = item
-                params[str(id(item))] = _format_field(value, parts, conv, spec,
-                                                      want_bytes)
-        for name, items in self._nested.items():
+        want_bytes = isinstance(self.format_string, _byte_strings)
+        slots = list(self._slots)
+        for name, (parts, getter, items, children) in self._tree:
             value = kwargs[name]
+            if getter is not None:
+                value = getter(value)
             for item in items:
-                parts, conv, spec = item
-                spec = spec % params
-                params[str(id(item))] = _format_field(value, parts, conv, spec,
-                                                      want_bytes)
-        return self._string % params
+                slots[item[4]] = _format_field(value, None, item[2], item[3],
+                                               want_bytes)
+            if not children:
+                continue
+            # walk the prefix tree, each common prefix is looked up once
+            stack = [(value, child) for child in children]
+            while stack:
+                value, (parts, getter, items, children) = stack.pop()
+                value = getter(value)
+                for item in items:
+                    slots[item[4]] = _format_field(value, None, item[2],
+                                                   item[3], want_bytes)
+                for child in children:
+                    stack.append((value, child))
+        join = self.format_string[:0].join
+        for name, (parts, getter, conv, spec, slot) in self._nested:
+            spec = _parse_spec(join([slots[i] for i in spec]))
+            slots[slot] = _format_field(kwargs[name], getter, conv, spec,
+                                        want_bytes)
+        return join([slots[i] for i in self._chunks])
+
+    def aformat(self, *args, **kwargs):
+        """Same as format(), but the values of the fields may be awaitable.
+
+        The awaitable arguments, attributes and items are resolved
+        concurrently with asyncio.gather(), level by level.  Return an
+        asyncio future of the result.  It is called in the running event
+        loop, like asyncio.ensure_future().
+        """
+        import asyncio
+        import inspect
+        if args:
+            kwargs.update(dict((str(i), value)
+                               for (i, value) in enumerate(args)))
+        try:
+            loop = asyncio.get_running_loop()
+        except AttributeError:  # Python < 3.7
+            loop = asyncio.get_event_loop()
+        result = loop.create_future()
+        fields = self._items()
+        # resolved values, keyed by (name,) + parts
+        values = {}
+
+        def resolve():
+            # Look up the fields, until the next awaitable values
+            pending = {}
+            try:
+                for name, item in fields:
+                    key = (name,)
+                    if key not in values:
+                        values[key] = kwargs[name]
+                    for part in item[0] + (None,):
+                        value = values[key]
+                        if inspect.isawaitable(value):
+                            pending[key] = value
+                            break
+                        if part is None:
+                            break
+                        key += (part,)
+                        if key not in values:
+                            if part[0]:
+                                values[key] = value[part[1]]
+                            else:
+                                values[key] = getattr(value, part[1])
+            except Exception:
+                # the pending coroutines will never be awaited
+                for value in pending.values():
+                    if inspect.iscoroutine(value):
+                        value.close()
+                raise
+            if not pending:
+                result.set_result(self._format_values(dict(
+                    (item[4], values[(name,) + item[0]])
+                    for (name, item) in fields)))
+                return
+            keys = list(pending)
+            gathered = asyncio.gather(*[pending[key] for key in keys])
+
+            def done(gathered):
+                if result.done():
+                    # cancelled by the caller
+                    return
+                try:
+                    if gathered.cancelled():
+                        result.cancel()
+                        return
+                    for key, value in zip(keys, gathered.result()):
+                        values[key] = value
+                    resolve()
+                except Exception:
+                    result.set_exception(sys.exc_info()[1])
+            gathered.add_done_callback(done)
+
+            def cancel(result):
+                # cancelled by the caller: stop the pending lookups
+                if result.cancelled():
+                    gathered.cancel()
+            result.add_done_callback(cancel)
+        try:
+            resolve()
+        except Exception:
+            result.set_exception(sys.exc_info()[1])
+        return result
+
+    def _format_values(self, values):
+        # Format the fields with their values, keyed by slot
+        want_bytes = isinstance(self.format_string, _byte_strings)
+        slots = list(self._slots)
+        join = self.format_string[:0].join
+        for name, (parts, getter, conv, spec, slot) in self._items():
+            if not isinstance(spec, _FormatSpec):
+                spec = _parse_spec(join([slots[i] for i in spec]))
+            slots[slot] = _format_field(values[slot], None, conv, spec,
+                                        want_bytes)
+        return join([slots[i] for i in self._chunks])
+
+    def _items(self):
+        # The (name, item) pairs of the fields, the computed specs last
+        return [value for value in self._slots if isinstance(value, tuple)
+                and isinstance(value[1][3], _FormatSpec)] + list(self._nested)
+
+    def iter_format(self, *args, **kwargs):
+        """Same as format(), but generate the chunks of the result.
+
+        The literal chunks and the replacement fields are yielded one at a
+        time, without building the whole string.
+        """
+        if args:
+            kwargs.update(dict((str(i), value)
+                               for (i, value) in enumerate(args)))
+        want_bytes = isinstance(self.format_string, _byte_strings)
+        join = self.format_string[:0].join
+        slots = self._slots
+
+        def chunk(slot):
+            value = slots[slot]
+            if isinstance(value, tuple):
+                name, (parts, getter, conv, spec, _) = value
+                if not isinstance(spec, _FormatSpec):
+                    spec = _parse_spec(join([chunk(i) for i in spec]))
+                value = _format_field(kwargs[name], getter, conv, spec,
+                                      want_bytes)
+            return value
+        for slot in self._chunks:
+            yield chunk(slot)
+
+    def format_to(self, fp, *args, **kwargs):
+        """Same as format(), but write the chunks of the result to fp.
+
+        The argument fp is a file-like object, or a callable like the method
+        append() of a list.
+        """
+        write = getattr(fp, 'write', fp)
+        for chunk in self.iter_format(*args, **kwargs):
+            write(chunk)
+
+    def format_many(self, rows):
+        """Format the template for each row of arguments.
+
+        A row is either a sequence of positional arguments or a mapping of
+        keyword arguments.  Return an iterator over the results.  The
+        template is compiled first, see compile().
+        """
+        func = self.compile()._func
+        no_args, no_kwargs = (), {}
+        for row in rows:
+            if hasattr(row, 'keys'):
+                yield func(no_args, row)
+            else:
+                yield func(row, no_kwargs)
+
+    def write_many(self, fp, rows, buffer_size=65536):
+        """Format the template for each row, and write the results to fp.
+
+        Same as format_many(), but the results are joined in blocks of
+        about buffer_size characters, and each block is written at once.
+        The number of rows per block is computed with min_length().  The
+        argument fp is a file-like object, or a callable.  Return the
+        number of rows.
+        """
+        import itertools
+        write = getattr(fp, 'write', fp)
+        join = self.format_string[:0].join
+        per_block = max(1, buffer_size // max(1, self.min_length()))
+        results = self.format_many(rows)
+        count = 0
+        while True:
+            block = list(itertools.islice(results, per_block))
+            if not block:
+                return count
+            write(join(block))
+            count += len(block)
+
+    def format_parallel(self, rows, max_workers=None, chunksize=1000):
+        """Format the template for each row of arguments, in processes.
+
+        Same as format_many(), but the rows are sent by chunks to the
+        workers of a concurrent.futures.ProcessPoolExecutor.  The compiled
+        template is sent once to each worker, or with each chunk before
+        Python 3.7.  Return an iterator over the results, in order; the rows
+        are consumed as the results are read.
+        """
+        from concurrent.futures import ProcessPoolExecutor
+        import itertools
+        if max_workers is None:
+            import multiprocessing
+            max_workers = multiprocessing.cpu_count()
+        if sys.version_info >= (3, 7):
+            executor = ProcessPoolExecutor(max_workers,
+                                           initializer=_init_worker,
+                                           initargs=(self.compile(),))
+            extra = ()
+        else:
+            # no initializer
+            executor = ProcessPoolExecutor(max_workers)
+            extra = (self.compile(),)
+        rows = iter(rows)
+        pending = []
+        try:
+            while True:
+                chunk = list(itertools.islice(rows, chunksize))
+                if chunk:
+                    pending.append(executor.submit(_format_rows, chunk,
+                                                   *extra))
+                if not chunk or len(pending) > max_workers:
+                    if not pending:
+                        break
+                    for result in pending.pop(0).result():
+                        yield result
+        except:
+            # wait for the running chunks, an abandoned pool blocks the exit
+            for future in pending:
+                future.cancel()
+            executor.shutdown()
+            raise
+        executor.shutdown()
+
+    def format_columns(self, *args, **kwargs):
+        """Format the template with columns of arguments.
+
+        Each argument is a sequence of values, and all the sequences have
+        the same length.  Each replacement field is formatted for the whole
+        column at once.  Return the list of results.
+        """
+        if args:
+            kwargs.update(dict((str(i), value)
+                               for (i, value) in enumerate(args)))
+        lengths = set([len(values) for values in kwargs.values()])
+        if len(lengths) > 1:
+            raise ValueError("columns must have the same length")
+        want_bytes = isinstance(self.format_string, _byte_strings)
+        slots = self._slots
+        columns = {}
+        join = self.format_string[:0].join
+        for name, (parts, getter, conv, spec, slot) in self._items():
+            values = kwargs[name]
+            if isinstance(spec, _FormatSpec):
+                columns[slot] = [
+                    _format_field(value, getter, conv, spec, want_bytes)
+                    for value in values]
+                continue
+            column = columns[slot] = []
+            for i, value in enumerate(values):
+                row_spec = []
+                for j in spec:
+                    if j in columns:
+                        row_spec.append(columns[j][i])
+                    else:
+                        row_spec.append(slots[j])
+                column.append(_format_field(value, getter, conv,
+                                            _parse_spec(join(row_spec)),
+                                            want_bytes))
+        template, fields = [], []
+        for slot in self._chunks:
+            if slot in columns:
+                template.append('%s')
+                fields.append(columns[slot])
+            else:
+                template.append(slots[slot].replace('%', '%%'))
+        template = join(template)
+        if not fields:
+            return [template % ()] * (lengths and lengths.pop() or 0)
+        return [template % row for row in zip(*fields)]
+
+
+# The template of format_parallel(), in the worker processes
+_worker_template = None
+
+
+def _init_worker(template):
+    global _worker_template
+    _worker_template = template
+
+
+def _format_rows(rows, template=None):
+    if template is None:
+        template = _worker_template
+    return list(template.format_many(rows))
+
+
+class BytesFormatter(object):
+    """Format a template to bytes, with one encoding policy.
+
+    The template is formatted as text, and the result is encoded once
+    with encoding and errors, instead of converting each field.  A bytes
+    format string is decoded with the same encoding.  The template is
+    compiled.
+    """
+
+    __slots__ = ('encoding', 'errors', 'template')
+
+    def __init__(self, format_string, encoding='ascii', errors='strict'):
+        if not isinstance(format_string, unicode):
+            format_string = format_string.decode(encoding)
+        self.encoding = encoding
+        self.errors = errors
+        self.template = FormattableString(format_string).compile()
+
+    def format(self, *args, **kwargs):
+        """Same as FormattableString.format(), but return bytes."""
+        return self.template._func(args, kwargs).encode(self.encoding,
+                                                        self.errors)
+
+    def format_into(self, buffer, *args, **kwargs):
+        """Append the result to a bytearray, and return its length."""
+        data = self.template._func(args, kwargs).encode(self.encoding,
+                                                        self.errors)
+        buffer.extend(data)
+        return len(data)
+
+    def format_many(self, rows):
+        """Same as FormattableString.format_many(), but yield bytes."""
+        encoding, errors = self.encoding, self.errors
+        for rv in self.template.format_many(rows):
+            yield rv.encode(encoding, errors)
+
+    def write_many(self, fp, rows, buffer_size=65536):
+        """Same as FormattableString.write_many(), but write bytes.
+
+        Each block is encoded at once.
+        """
+        write = getattr(fp, 'write', fp)
+        encoding, errors = self.encoding, self.errors
+
+        def write_block(text):
+            write(text.encode(encoding, errors))
+        return self.template.write_many(write_block, rows, buffer_size)
+
+
+class _TemplateCache(object):
+    """Bounded LRU cache of FormattableString instances.
+
+    Templates are keyed by (format_string, type), so that a str and a unicode
+    template which compare equal are cached separately.  With maxsize=None
+    the cache is unbounded, with maxsize=0 it is disabled.  With
+    compiled=True, the new templates are compiled to Python code.
+    """
+
+    def __init__(self, maxsize=DEFAULT_CACHE_SIZE, compiled=False):
+        self._lock = threading.Lock()
+        self._map = {}
+        self.compiled = compiled
+        # circular doubly linked list: [prev, next, key, value]
+        self._root = root = []
+        root[:] = [root, root, None, None]
+        self.maxsize = maxsize
+        self.hits = self.misses = self.evictions = 0
+
+    def __len__(self):
+        return len(self._map)
+
+    def get(self, format_string):
+        """Return the FormattableString for this format_string."""
+        key = (format_string, type(format_string))
+        self._lock.acquire()
+        try:
+            link = self._map.get(key)
+            if link is not None:
+                # move the link to the front of the list
+                link_prev, link_next, _, value = link
+                link_prev[1] = link_next
+                link_next[0] = link_prev
+                root = self._root
+                last = root[0]
+                last[1] = root[0] = link
+                link[0] = last
+                link[1] = root
+                self.hits += 1
+                return value
+            self.misses += 1
+        finally:
+            self._lock.release()
+        # parse outside of the lock; a concurrent miss will parse twice
+        value = FormattableString(format_string)
+        if self.compiled:
+            value.compile()
+        if self.maxsize == 0:
+            return value
+        self._lock.acquire()
+        try:
+            if key not in self._map:
+                self._insert(key, value)
+        finally:
+            self._lock.release()
+        return value
+
+    def add(self, value):
+        """Add a FormattableString to the cache, if it is missing."""
+        if self.compiled:
+            value.compile()
+        if self.maxsize == 0:
+            return
+        format_string = value.format_string
+        key = (format_string, type(format_string))
+        self._lock.acquire()
+        try:
+            if key not in self._map:
+                self._insert(key, value)
+        finally:
+            self._lock.release()
+
+    def templates(self):
+        """Return the list of the cached templates, most recent last."""
+        self._lock.acquire()
+        try:
+            rv = []
+            root = self._root
+            link = root[1]
+            while link is not root:
+                rv.append(link[3])
+                link = link[1]
+            return rv
+        finally:
+            self._lock.release()
+
+    def _insert(self, key, value):
+        root = self._root
+        if self.maxsize is not None and len(self._map) >= self.maxsize:
+            # evict the least recently used template
+            oldest = root[1]
+            root[1] = oldest[1]
+            oldest[1][0] = root
+            del self._map[oldest[2]]
+            self.evictions += 1
+        last = root[0]
+        last[1] = root[0] = self._map[key] = [last, root, key, value]
+
+    def resize(self, maxsize):
+        """Change the maximum size, evicting templates if needed."""
+        self._lock.acquire()
+        try:
+            self.maxsize = maxsize
+            if maxsize is not None:
+                root = self._root
+                while len(self._map) > maxsize:
+                    oldest = root[1]
+                    root[1] = oldest[1]
+                    oldest[1][0] = root
+                    del self._map[oldest[2]]
+                    self.evictions += 1
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """Remove all templates and reset the statistics."""
+        self._lock.acquire()
+        try:
+            self._map.clear()
+            root = self._root
+            root[:] = [root, root, None, None]
+            self.hits = self.misses = self.evictions = 0
+        finally:
+            self._lock.release()
+
+
+class TemplateRegistry(object):
+    """Registry of compiled templates, shared between threads.
+
+    The lookups do not take any lock: the templates are kept in a dict
+    which is never modified once published.  A new template is added to a
+    copy of the dict, which replaces the previous one.  The registered
+    templates are parsed and compiled before they are published.  When
+    maxsize is reached, the new templates are returned without being
+    registered nor compiled.
+    """
+
+    def __init__(self, templates=(), maxsize=None):
+        self._lock = threading.Lock()
+        self._templates = {}
+        self.maxsize = maxsize
+        for format_string in templates:
+            self.get(format_string)
+
+    def __len__(self):
+        return len(self._templates)
+
+    def __contains__(self, format_string):
+        return (format_string, type(format_string)) in self._templates
+
+    def get(self, format_string):
+        """Return the FormattableString for this format_string."""
+        try:
+            return self._templates[(format_string, type(format_string))]
+        except KeyError:
+            # parse outside of the lock; a concurrent miss will parse twice
+            return self.add(FormattableString(format_string))
+
+    def add(self, template):
+        """Register a FormattableString, if it is missing.
+
+        Return the registered template for the same format string.
+        """
+        format_string = template.format_string
+        key = (format_string, type(format_string))
+        templates = self._templates
+        if key in templates:
+            return templates[key]
+        if self.maxsize is not None and len(templates) >= self.maxsize:
+            return template
+        # compile outside of the lock
+        template.compile()
+        self._lock.acquire()
+        try:
+            templates = self._templates
+            if key in templates:
+                return templates[key]
+            if self.maxsize is None or len(templates) < self.maxsize:
+                templates = templates.copy()
+                templates[key] = template
+                self._templates = templates
+        finally:
+            self._lock.release()
+        return template
+
+    def format(self, format_string, *args, **kwargs):
+        """Same as format_string.format(*args, **kwargs)."""
+        return self.get(format_string).format(*args, **kwargs)
+
+    def templates(self):
+        """Return the list of the registered templates."""
+        return list(self._templates.values())
+
+    def clear(self):
+        """Remove all templates."""
+        self._lock.acquire()
+        try:
+            self._templates = {}
+        finally:
+            self._lock.release()
+
+_cache = _TemplateCache()
+
+
+def cache_info():
+    """Return the statistics of the template cache used by str.format.
+
+    The result is a dict with keys 'hits', 'misses', 'evictions',
+    'maxsize' and 'currsize'.
+    """
+    return {'hits': _cache.hits, 'misses': _cache.misses,
+            'evictions': _cache.evictions, 'maxsize': _cache.maxsize,
+            'currsize': len(_cache)}
+
+
+def cache_clear():
+    """Clear the template cache used by str.format."""
+    _cache.clear()
+
+
+class _Interner(object):
+    """Table of the templates, and of the objects they share.
+
+    The equal literal chunks, fields, format specifications and prefix
+    trees of the templates are stored once.  There is one table per type
+    of format string, because u'a' == 'a' in Python 2.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.templates = {}
+        self.objects = {}
+
+    def __len__(self):
+        return len(self.templates)
+
+    def get(self, format_string):
+        """Return the shared FormattableString for this format_string."""
+        key = (format_string, type(format_string))
+        try:
+            return self.templates[key]
+        except KeyError:
+            pass
+        template = FormattableString(format_string)
+        self._lock.acquire()
+        try:
+            if key not in self.templates:
+                self.templates[key] = self.compact(template)
+            return self.templates[key]
+        finally:
+            self._lock.release()
+
+    def compact(self, fs):
+        """Replace the parts of fs with the shared objects.  Return fs."""
+        table = self.objects.setdefault(type(fs.format_string), {})
+
+        def share(obj, value=None):
+            if value is None:
+                value = obj
+            return table.setdefault(obj, value)
+
+        def getter(parts, getter):
+            if parts:
+                getter = share((_make_getter, parts), getter)
+            return getter
+
+        def field(name, item):
+            parts, get, conv, spec, slot = item
+            parts = share(tuple([share(part) for part in parts]))
+            if isinstance(spec, _FormatSpec):
+                spec = share((_FormatSpec, spec.format_spec), spec)
+            else:
+                spec = share(spec)
+            item = share((parts, getter(parts, get), conv, spec, slot))
+            return share((share(name), item))
+
+        def tree(node):
+            parts, get, items, children = node
+            parts = share(parts)
+            return share((parts, getter(parts, get), share(items),
+                          tuple([tree(child) for child in children])))
+        slots = []
+        for value in fs._slots:
+            if isinstance(value, tuple):
+                value = field(*value)
+            else:
+                value = share(value)
+            slots.append(value)
+        _set_fields(fs, slots)
+        fs._slots = share(fs._slots)
+        fs._chunks = share(fs._chunks)
+        fs._nested = share(fs._nested)
+        fs._tree = share(tuple([share((name, tree(node)))
+                                for (name, node) in fs._tree]))
+        return fs
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self.templates = {}
+            self.objects = {}
+        finally:
+            self._lock.release()
+
+_interner = _Interner()
+
+
+def intern_template(format_string):
+    """Return the compact FormattableString for this format_string.
+
+    The same instance is returned for equal format strings, and the parsed
+    chunks and fields are shared with the other interned templates.  This
+    saves memory for large catalogs of templates, like translations.  The
+    interned templates are not compiled.
+    """
+    return _interner.get(format_string)
+
+
+def intern_clear():
+    """Release the interned templates."""
+    _interner.clear()
+
+
+def _deep_size(objects):
+    # Sum the sizes of the objects and their contents, once each
+    seen = set()
+    size = 0
+    stack = list(objects)
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, type):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (tuple, list)):
+            stack.extend(obj)
+        elif isinstance(obj, (FormattableString, _FormatSpec)):
+            stack.extend([getattr(obj, name) for name in obj.__slots__
+                          if hasattr(obj, name)])
+    return size
+
+
+def memory_report(templates):
+    """Compare the memory used by the templates, plain and interned.
+
+    The templates are format strings.  Return a dict with keys 'count',
+    'unique', 'plain' and 'compact'.  The last two are the average sizes
+    of a template in bytes, when each template is parsed separately and
+    when the templates are interned, the tables included.
+    """
+    templates = list(templates)
+    count = len(templates) or 1
+    interner = _Interner()
+    for format_string in templates:
+        interner.get(format_string)
+    plain = [FormattableString(format_string) for format_string in templates]
+    return {'count': len(templates), 'unique': len(interner),
+            'plain': _deep_size(plain) // count,
+            'compact': _deep_size([interner.templates,
+                                   interner.objects]) // count}
+
+
+class BraceMessage(object):
+    """Message which is formatted on first use, for logging.
+
+    The template and the arguments are kept until str() is called, then
+    the result is cached.  The messages dropped by the logging level or
+    the filters are never formatted.
+
+    >>> log.debug(BraceMessage('{0} items in {1:.2f}s', count, elapsed))
+    """
+
+    __slots__ = ('args', 'format_string', 'kwargs', '_message')
+
+    def __init__(self, format_string, *args, **kwargs):
+        self.format_string = format_string
+        self.args = args
+        self.kwargs = kwargs
+        self._message = None
+
+    def render(self):
+        """Return the formatted message, with the type of the template."""
+        # the arguments are read first: they are released after the
+        # message is set, maybe by another thread
+        args, kwargs = self.args, self.kwargs
+        message = self._message
+        if message is None:
+            template = _cache.get(self.format_string)
+            message = self._message = template.format(*args, **kwargs)
+            # release the arguments
+            self.args, self.kwargs = (), {}
+        return message
+
+    def __str__(self):
+        return str(self.render())
+
+    def __unicode__(self):
+        return unicode(self.render())
+
+    def __repr__(self):
+        if self._message is None:
+            return '<BraceMessage %r>' % (self.format_string,)
+        return '<BraceMessage %r>' % (self._message,)
+
+
+def _get_message(record):
+    """Return the message of a logging record, with the '{' style.
+
+    With a mapping as argument, the message is formatted with this
+    mapping as the first positional argument and the keyword arguments.
+    A message without replacement field is formatted with the '%' style.
+    """
+    msg, args = record.msg, record.args
+    if not args or not isinstance(msg, (str, unicode)):
+        return record.getMessage()
+    template = _message_cache.get(msg)
+    if not template._tree and not template._nested:
+        return record.getMessage()
+    if hasattr(args, 'keys'):
+        return template.format(args, **args)
+    return template.format(*args)
+
+
+# The templates of the log messages, apart from the cache of str.format
+_message_cache = _TemplateCache()
+
+
+class BraceFormatter(logging.Formatter):
+    """Logging formatter for the '{' style.
+
+    The format string of the formatter is a template, which is formatted
+    with the attributes of the record, like '{asctime} {levelname}:
+    {message}'.  The messages are formatted with record.getMessage(), like
+    the '%' style of the other libraries.  With brace_messages=True, the
+    messages of the records with arguments are templates too.
+
+    The argument style is the one of logging.Formatter: it is '{', or '%'
+    which logging.config passes by default.
+    """
+
+    def __init__(self, fmt=None, datefmt=None, style='{',
+                 brace_messages=False):
+        if style not in ('{', '%'):
+            raise ValueError("BraceFormatter does not support the %r style"
+                             % (style,))
+        logging.Formatter.__init__(self, None, datefmt)
+        self._fmt = fmt or '{message}'
+        self._template = FormattableString(self._fmt)
+        self.brace_messages = brace_messages
+
+    def usesTime(self):
+        return 'asctime' in [name for (name, item)
+                             in self._template._items()]
+
+    def format(self, record):
+        if self.brace_messages:
+            record.message = _get_message(record)
+        else:
+            record.message = record.getMessage()
+        if self.usesTime():
+            record.asctime = self.formatTime(record, self.datefmt)
+        s = self._template.format(**record.__dict__)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            if s[-1:] != '\n':
+                s += '\n'
+            s += record.exc_text
+        if getattr(record, 'stack_info', None):
+            if s[-1:] != '\n':
+                s += '\n'
+            s += self.formatStack(record.stack_info)
+        return s
+
+
+# Profiling: [calls, format time, parses, parse time, failures] by template
+_profile = {}
+_profile_lock = threading.Lock()
+_unprofiled = {}
+_timer = getattr(time, 'perf_counter', time.time)
+
+
+def _record(format_string, offset, elapsed, failed):
+    key = (format_string, type(format_string))
+    _profile_lock.acquire()
+    try:
+        entry = _profile.get(key)
+        if entry is None:
+            entry = _profile[key] = [0, 0.0, 0, 0.0, 0]
+        entry[offset] += 1
+        entry[offset + 1] += elapsed
+        entry[4] += failed
+    finally:
+        _profile_lock.release()
+
+
+def enable_profiling():
+    """Record the calls and the timings of the templates.
+
+    The parsing and the method format() of FormattableString are replaced
+    with timed wrappers, which apply to str.format too when it is patched.
+    A lazy template is timed as a parse on first use.  There is no
+    overhead when the profiling is disabled.
+    """
+    if _unprofiled:
+        return
+    # the functions, not the unbound methods of Python 2
+    parse_method = FormattableString.__dict__['_parse']
+    format_method = FormattableString.__dict__['format']
+    _unprofiled.update(_parse=parse_method, format=format_method)
+
+    def _parse(self):
+        start = _timer()
+        try:
+            parse_method(self)
+        except Exception:
+            _record(self.format_string, 2, _timer() - start, 1)
+            raise
+        _record(self.format_string, 2, _timer() - start, 0)
+
+    def format(self, *args, **kwargs):
+        # a lazy template is parsed first, out of the format time
+        self._tree
+        start = _timer()
+        try:
+            rv = format_method(self, *args, **kwargs)
+        except Exception:
+            _record(self.format_string, 0, _timer() - start, 1)
+            raise
+        _record(self.format_string, 0, _timer() - start, 0)
+        return rv
+    format.__doc__ = format_method.__doc__
+    FormattableString._parse = _parse
+    FormattableString.format = format
+
+
+def disable_profiling():
+    """Stop recording, and restore the methods of FormattableString.
+
+    The statistics are kept until profile_clear().
+    """
+    for name, method in _unprofiled.items():
+        setattr(FormattableString, name, method)
+    _unprofiled.clear()
+
+
+def profile_stats(limit=None, sort='format_time'):
+    """Return the statistics of the templates, the most expensive first.
+
+    Each entry is a dict with keys 'template', 'calls', 'format_time',
+    'parses', 'parse_time' and 'failures'.  The times are in seconds, and
+    the entries are sorted on the key sort, in decreasing order.
+    """
+    _profile_lock.acquire()
+    try:
+        stats = [{'template': key[0], 'calls': calls,
+                  'format_time': format_time, 'parses': parses,
+                  'parse_time': parse_time, 'failures': failures}
+                 for (key, (calls, format_time, parses, parse_time, failures))
+                 in _profile.items()]
+    finally:
+        _profile_lock.release()
+    stats.sort(key=operator.itemgetter(sort), reverse=True)
+    return stats[:limit]
+
+
+def profile_clear():
+    """Reset the statistics of the profiling."""
+    _profile.clear()
+
+
+# Version of the file format of save_templates()
+_STATE_VERSION = 1
+_STATE_MAGIC = 'stringformat-templates'
+
+
+def _dump_state(fs):
+    """Return the parsed template as a tuple of builtin types.
+
+    The tuple (format_string, chunks, fields) can be serialized with
+    marshal.  The chunks are literal strings or indexes in the list of
+    fields (name, parts, conversion, spec).  The spec of a computed format
+    specifier is a list of chunks.
+    """
+    slots = fs._slots
+    fields = []
+    indexes = {}
+
+    def chunks(template):
+        rv = []
+        for slot in template:
+            value = slots[slot]
+            if isinstance(value, tuple):
+                if slot not in indexes:
+                    name, (parts, getter, conv, spec, _) = value
+                    if isinstance(spec, _FormatSpec):
+                        spec = spec.format_spec
+                    else:
+                        spec = chunks(spec)
+                    indexes[slot] = len(fields)
+                    fields.append((name, parts, conv, spec))
+                value = indexes[slot]
+            rv.append(value)
+        return rv
+    return (fs.format_string, chunks(fs._chunks), fields)
+
+
+def _load_state(state, fs=None):
+    """Rebuild a FormattableString from the result of _dump_state()."""
+    format_string, chunks, fields = state
+    if fs is None:
+        fs = FormattableString.__new__(FormattableString)
+    fs._func = None
+    fs.format_string = format_string
+    slots = []
+    keys = [None] * len(fields)
+
+    def template(chunks):
+        rv = []
+        for chunk in chunks:
+            if isinstance(chunk, int):
+                rv.append(keys[chunk])
+            else:
+                rv.append(len(slots))
+                slots.append(chunk)
+        return rv
+    # the computed format specifiers refer to the other fields
+    for nested in False, True:
+        for i, (name, parts, conv, spec) in enumerate(fields):
+            if isinstance(spec, list) is nested:
+                if nested:
+                    spec = tuple(template(spec))
+                else:
+                    spec = _parse_spec(spec)
+                item = (parts, _make_getter(parts), conv, spec, len(slots))
+                slots.append((name, item))
+                keys[i] = item[4]
+    fs._chunks = tuple(template(chunks))
+    _set_fields(fs, slots)
+    return fs
+
+
+def save_templates(filename, templates=None):
+    """Save the parsed templates to a file, for load_templates().
+
+    The templates are strings or FormattableString instances.  By default,
+    the templates of the str.format cache are saved.  The file is specific
+    to the version of Python.
+    """
+    if templates is None:
+        templates = _cache.templates()
+    states = []
+    for template in templates:
+        if not isinstance(template, FormattableString):
+            template = FormattableString(template)
+        states.append(_dump_state(template))
+    header = (_STATE_MAGIC, _STATE_VERSION, tuple(sys.version_info[:2]))
+    fp = open(filename, 'wb')
+    try:
+        marshal.dump((header, states), fp)
+    finally:
+        fp.close()
+
+
+def load_templates(filename):
+    """Load the templates saved by save_templates().
+
+    The templates are added to the str.format cache without parsing them
+    again.  Return the list of FormattableString instances.  The file is
+    ignored if it was saved by another version.  Only load trusted files.
+    """
+    fp = open(filename, 'rb')
+    try:
+        try:
+            header, states = marshal.load(fp)
+        except (EOFError, ValueError, TypeError):
+            return []
+    finally:
+        fp.close()
+    if header != (_STATE_MAGIC, _STATE_VERSION, tuple(sys.version_info[:2])):
+        return []
+    rv = []
+    for state in states:
+        fs = _load_state(state)
+        _cache.add(fs)
+        rv.append(fs)
+    return rv
+
+
+def precompile(templates):
+    """Parse the templates and add them to the str.format cache.
+
+    The templates are strings or FormattableString instances.  Return the
+    list of FormattableString instances; the first invalid template raises
+    ValueError.  See save_templates() to store them.
+    """
+    rv = []
+    for template in templates:
+        if not isinstance(template, FormattableString):
+            try:
+                template = FormattableString(template)
+            except ValueError:
+                raise ValueError('%s: %r' % (sys.exc_info()[1], template))
+        _cache.add(template)
+        rv.append(template)
+    return rv
+
+
+def _literal(node):
+    # Return the value of a string literal node, or None
+    name = node.__class__.__name__
+    if name == 'Str':
+        return node.s
+    if name == 'Constant' and isinstance(node.value, (str, unicode)):
+        return node.value
+    return None
+
+
+def _scan_source(source, filename='<string>'):
+    """Return the list of (lineno, template) found in the Python source.
+
+    The templates are the string literals followed by .format( and the
+    first argument of the FormattableString() calls.
+    """
+    import ast
+    rv = []
+    for node in ast.walk(ast.parse(source, filename)):
+        if node.__class__.__name__ != 'Call':
+            continue
+        func = node.func
+        if func.__class__.__name__ == 'Attribute' and func.attr == 'format':
+            template = _literal(func.value)
+        elif (getattr(func, 'id', None) == 'FormattableString' or
+              getattr(func, 'attr', None) == 'FormattableString'):
+            template = node.args and _literal(node.args[0]) or None
+        else:
+            continue
+        if template is not None:
+            rv.append((node.lineno, template))
+    rv.sort()
+    return rv
+
+
+def main(args=None):
+    """Command line: check the templates of Python files, and save them.
+
+    Without argument, run the self test.
+    """
+    import optparse
+    import os
+    if args is None:
+        args = sys.argv[1:]
+    if not args:
+        selftest()
+        return 0
+    parser = optparse.OptionParser(
+        usage='%prog [-o FILENAME] PATH...',
+        description='Check the templates of the Python files, and save '
+                    'them for load_templates().')
+    parser.add_option('-o', '--output', metavar='FILENAME',
+                      help='save the valid templates to this file')
+    options, paths = parser.parse_args(args)
+    filenames = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, names in os.walk(path):
+                dirnames.sort()
+                filenames.extend([os.path.join(dirpath, name)
+                                  for name in sorted(names)
+                                  if name.endswith('.py')])
+        else:
+            filenames.append(path)
+    templates, errors = [], 0
+    for filename in filenames:
+        fp = open(filename, 'rb')
+        try:
+            source = fp.read()
+        finally:
+            fp.close()
+        try:
+            found = _scan_source(source, filename)
+        except SyntaxError:
+            print('%s: cannot parse: %s' % (filename, sys.exc_info()[1]))
+            continue
+        for lineno, template in found:
+            try:
+                templates.append(FormattableString(template))
+            except ValueError:
+                errors += 1
+                print('%s:%d: %s: %r' % (filename, lineno,
+                                         sys.exc_info()[1], template))
+    templates = precompile(templates)
+    if options.output:
+        save_templates(options.output, templates)
+    print('%d templates in %d files, %d errors' % (
+        len(templates), len(filenames), errors))
+    return errors and 1 or 0
 
 
 # the code below is used to monkey patch builtins
@@ -323,14 +2138,31 @@ def _patch_builtin_types():
         Return a formatted version of S, using substitutions from args and kwargs.
         The substitutions are identified by braces ('{' and '}').
         """
-        return FormattableString(self).format(*args, **kwargs)
+        return _cache.get(self).format(*args, **kwargs)
 
     # This does the actual monkey patch on str and unicode
     for cls in str, unicode:
         get_class_dict(cls)['format'] = format
 
 
-def init(force=False):
+# Default value of the arguments of init() which are left unchanged
+_unchanged = object()
+
+
+def init(force=False, cache_size=_unchanged, compiled=None):
+    """Add the method format() to str and unicode, if it is missing.
+
+    With force=True, replace the builtin method.  The parsed templates are
+    kept in a LRU cache of cache_size entries (None means unbounded, and 0
+    disables the cache).  With compiled=True, they are compiled to Python
+    code, see FormattableString.compile().  The settings of the cache are
+    changed only when they are passed; they start with DEFAULT_CACHE_SIZE
+    and compiled=False.
+    """
+    if cache_size is not _unchanged:
+        _cache.resize(cache_size)
+    if compiled is not None:
+        _cache.compiled = compiled
     if force or not hasattr(str, 'format'):
         _patch_builtin_types()
 
@@ -362,4 +2194,4 @@ def selftest():
     print('Test successful')
 
 if __name__ == '__main__':
-    selftest()
+    sys.exit(main())
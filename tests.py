@@ -2,10 +2,12 @@
 #
 # Many tests were converted from the Python 2.7 standard library test suite.
 
+import os
 import sys
 import unittest
 
-from stringformat import FormattableString as f, _strformat
+from stringformat import FormattableString as f, _strformat, _emulate_format
+from stringformat import register_formatter, _parse_spec
 
 
 # object.__format__ does not exist in Python 2.5
@@ -41,20 +43,27 @@ class BaseFormatterTest(unittest.TestCase):
         # test both with and without the trailing 's'
         self.assertEqual(_strformat(value, fmt), expected)
         self.assertEqual(_strformat(value, fmt + 's'), expected)
+        # test the pure Python implementation too
+        self.assertEqual(_emulate_format(value, _parse_spec(fmt)), expected)
 
     def _check_format(self, expected, fmt, *args, **kwargs):
         fmt, expected = self._prepare(fmt, expected)
         self.assertEqual(f(fmt).format(*args, **kwargs), expected)
+        self.assertEqual(f(fmt).compile().format(*args, **kwargs), expected)
 
     def _check_raises(self, expected_exception, fmt, *args, **kwargs):
         fmt = self._prepare(fmt)
-        try:
-            f(fmt).format(*args, **kwargs)
-        except expected_exception:
-            pass
-        else:
-            raise self.failureException('%s not raised' %
-                                        expected_exception.__name__)
+        for compiled in False, True:
+            try:
+                template = f(fmt)
+                if compiled:
+                    template.compile()
+                template.format(*args, **kwargs)
+            except expected_exception:
+                pass
+            else:
+                raise self.failureException('%s not raised' %
+                                            expected_exception.__name__)
 
     assert_raises_25 = _check_raises
 
@@ -415,6 +424,238 @@ class BaseFormatterTest(unittest.TestCase):
         # The old-formatting '%s' is ignored.
         test('42%s', '{}%s', 42)
         test('abc: %s', 'abc: %s', 42)
+        test('2007-08 %', '{0:%Y-{1} %%}', d, '%m')
+
+    def test_format_many(self):
+        fmt, expected = self._prepare('{0:>3}|{1[a]}|{1[b]:.{2}}',
+                                      '  1|x|abc')
+        rows = [(1, {'a': 'x', 'b': 'abcdef'}, 3),
+                (22, {'a': 'y', 'b': 'ghijkl'}, 1)]
+        results = list(f(fmt).format_many(rows))
+        self.assertEqual(results[0], expected)
+        self.assertEqual(results[1], self._prepare(' 22|y|g'))
+        self.assertEqual(f(fmt).format_columns(*zip(*rows)), results)
+
+        fmt, expected = self._prepare('{name}: {n:{w}}%', 'ab:   1%')
+        rows = [dict(name='ab', n=1, w=3), dict(name='c', n=2, w=1)]
+        results = list(f(fmt).format_many(rows))
+        self.assertEqual(results, [expected, self._prepare('c: 2%')])
+        self.assertEqual(f(fmt).format_columns(name=['ab', 'c'], n=[1, 2],
+                                               w=[3, 1]), results)
+
+        fmt = self._prepare('-')
+        self.assertEqual(f(fmt).format_columns([1, 2]), [fmt, fmt])
+        self.assertEqual(list(f(fmt).format_many([])), [])
+        self.assertRaises(ValueError, f(fmt).format_columns, [1, 2], [1])
+
+    def test_format_parallel(self):
+        try:
+            import concurrent.futures
+        except ImportError:     # Python < 3.2
+            return
+        fmt = self._prepare('{0:>4}|{1[a]}|{1[b]:.{2}}')
+        rows = [(i, {'a': 'x', 'b': 'abcdef'}, i % 5) for i in range(250)]
+        template = f(fmt)
+        results = template.format_parallel(rows, max_workers=2, chunksize=7)
+        self.assertEqual(list(results), list(template.format_many(rows)))
+        results = template.format_parallel(iter(rows[:10]), chunksize=20)
+        self.assertEqual(list(results), list(template.format_many(rows[:10])))
+        results = template.format_parallel([(1, {})], max_workers=1)
+        self.assertRaises(KeyError, list, results)
+
+    def test_write_many(self):
+        fmt = self._prepare('{0:>4}|{1:<6}\n')
+        rows = [(i, 'x' * (i % 9)) for i in range(100)]
+        template = f(fmt)
+        blocks = []
+        self.assertEqual(template.write_many(blocks.append, rows, 120), 100)
+        # min_length() is 12: 10 rows per block
+        self.assertEqual(len(blocks), 10)
+        self.assertEqual(fmt[:0].join(blocks),
+                         fmt[:0].join(template.format_many(rows)))
+        self.assertEqual(template.write_many(blocks.append, []), 0)
+
+    def test_iter_format(self):
+        class C:
+            x = 'abc'
+        for fmt, args, kwargs in [('', (), {}),
+                                  ('a{{%s}}', (), {}),
+                                  ('{0}', ('x',), {}),
+                                  ('<{0.x:>{1}}|{w:{1}}>', (C(), 5), {'w': 7}),
+                                  ('{0:{1}{2}} {0:{1}}', (42, '<', 6), {})]:
+            fmt = self._prepare(fmt)
+            expected = f(fmt).format(*args, **kwargs)
+            chunks = list(f(fmt).iter_format(*args, **kwargs))
+            self.assertEqual(self._prepare('').join(chunks), expected)
+            chunks = []
+            f(fmt).format_to(chunks.append, *args, **kwargs)
+            self.assertEqual(self._prepare('').join(chunks), expected)
+
+        # a computed format specifier with an empty field
+        fmt = self._prepare('{0:{1}>5}')
+        expected = self._prepare('    a')
+        self.assertEqual(list(f(fmt).iter_format('a', '')), [expected])
+        self.assertEqual(f(fmt).format_columns(['a'], ['']), [expected])
+
+        fmt = self._prepare('a{0}b{1}')
+        self.assertEqual(list(f(fmt).iter_format('x', 'y')),
+                         list(self._prepare('a', 'x', 'b', 'y')))
+        # the chunks are generated until the missing argument
+        chunks = []
+        self.assertRaises(KeyError, f(fmt).format_to, chunks.append, 'x')
+        self.assertEqual(chunks, list(self._prepare('a', 'x', 'b')))
+
+    def test_shared_lookups(self):
+        calls = []
+
+        class User(object):
+            name, email, id = 'joe', 'joe@example.com', 42
+
+        class Request(object):
+            def user(self):
+                calls.append('user')
+                return User()
+            user = property(user)
+
+        class Spec(object):
+            def __format__(self, spec):
+                calls.append(spec)
+                return spec
+        fmt = self._prepare('{0.user.name} <{0.user.email}> #{0.user.id:03} '
+                            '{1:a} {1:b} {1:a}')
+        expected = self._prepare('joe <joe@example.com> #042 a b a')
+        for template in f(fmt), f(fmt).compile():
+            del calls[:]
+            self.assertEqual(template.format(Request(), Spec()), expected)
+            self.assertEqual(sorted(calls), ['a', 'b', 'user'])
+
+    def test_aformat(self):
+        try:
+            import asyncio
+        except ImportError:     # Python < 3.4
+            return
+        calls = []
+        rounds = []
+
+        def later(value):
+            calls.append(value)
+            return asyncio.sleep(0.01, result=value)
+
+        def gather(*awaitables):
+            rounds.append(len(awaitables))
+            return asyncio_gather(*awaitables)
+
+        def run(template, *args, **kwargs):
+            # aformat() is called in the running loop
+            futures = []
+            loop.call_soon(lambda: futures.append(template.aformat(*args,
+                                                                   **kwargs)))
+            loop.run_until_complete(asyncio.sleep(0))
+            return loop.run_until_complete(futures[0])
+
+        class User(object):
+            name = 'joe'
+            email = property(lambda self: later('joe@example.com'))
+
+        class Request(object):
+            user = property(lambda self: later(User()))
+
+        fmt = self._prepare('{0.user.name} <{0.user.email}> {1:>{w}} {2[0]}')
+        expected = self._prepare('joe <joe@example.com>   42 x')
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        asyncio_gather = asyncio.gather
+        asyncio.gather = gather
+        try:
+            for template in f(fmt), f(fmt).compile():
+                del calls[:], rounds[:]
+                result = run(template, Request(), later(42), ['x'],
+                             w=later(4))
+                self.assertEqual(result, expected)
+                # the user, the email, the 42 and the width
+                self.assertEqual(len(calls), 4)
+                # two levels of lookups, not four
+                self.assertEqual(rounds, [3, 1])
+                self.assertRaises(KeyError, run, template, Request(), 42)
+                self.assertRaises(IndexError, run, template, Request(), 42,
+                                  [], w=4)
+            # the caller cancels the result before the lookups are done
+            waiting = loop.create_future()
+            futures = []
+            loop.call_soon(lambda: futures.append(f(fmt).aformat(
+                Request(), waiting, ['x'], w=4)))
+            loop.run_until_complete(asyncio.sleep(0))
+            futures[0].cancel()
+            loop.run_until_complete(asyncio.sleep(0.05))
+            self.assertTrue(waiting.cancelled())
+        finally:
+            asyncio.gather = asyncio_gather
+            asyncio.set_event_loop(None)
+            loop.close()
+
+    def test_register_formatter(self):
+        class Money(float):
+            pass
+
+        class Euro(Money):
+            pass
+
+        def format_money(value, format_spec):
+            return _strformat(float(value), format_spec or '.2f') + ' $'
+        test = self._check_format
+        register_formatter(Money, format_money)
+        try:
+            test('1.50 $|2 $', '{0}|{0:.0f}', Money(1.5))
+            test('3.00 $', '{0}', Euro(3))
+            test('1.5', '{0}', 1.5)
+        finally:
+            register_formatter(Money, None)
+        test('1.5', '{0}', Money(1.5))
+        test('3.0', '{0}', Euro(3))
+
+    def test_compile_many_constants(self):
+        # more than 255 constants
+        fmt = self._prepare(''.join(['L%d{%d:>%d}' % (i, i % 5, i)
+                                     for i in range(200)]))
+        args = tuple(range(5))
+        self.assertEqual(f(fmt).compile().format(*args), fmt.format(*args))
+
+    def test_compile_field_names(self):
+        # neither an identifier nor a positional argument
+        fmt = self._prepare('{0.real\n}')
+        for template in f(fmt), f(fmt).compile():
+            self.assertRaises(AttributeError, template.format, 1)
+        if python_3:
+            template = f(u('{\xb2}'))
+            self.assertEqual(template.compile().format(**{u('\xb2'): 2}),
+                             u('2'))
+
+    def test_long_field_names(self):
+        class Node(object):
+            pass
+        node = Node()
+        setattr(node, 'if', node)
+        setattr(node, 'x\n', ['end'])
+        for fmt in ('{0[0].x\n[0]}', '{0[0]' + '.if' * 250 + '.x\n[0]}'):
+            fmt, expected = self._prepare(fmt, 'end')
+            for template in f(fmt), f(fmt).compile():
+                self.assertEqual(template.format([node]), expected)
+
+    def test_lazy(self):
+        fmt, expected = self._prepare('{0:>{1}}|{x.real}', '  a|2')
+        template = f(fmt, lazy=True)
+        # not parsed yet
+        self.assertRaises(AttributeError, object.__getattribute__,
+                          template, '_slots')
+        self.assertEqual(template.format('a', 3, x=2), expected)
+        self.assertEqual(template.format('a', 3, x=2), expected)
+        self.assertEqual(f(fmt, lazy=True).compile().format('a', 3, x=2),
+                         expected)
+        # the syntax errors are raised on use
+        template = f(self._prepare('{0!}'), lazy=True)
+        for n in range(2):
+            self.assertRaises(ValueError, template.format, 1)
+        self.assertRaises(ValueError, template.compile)
 
     def test_format_numeric(self):
         test = self._check_format
@@ -447,9 +688,28 @@ class BaseFormatterTest(unittest.TestCase):
 
         # XXX broken
         # test('42.000000%', '{0:%}', .42)        # TypeError
-        # test('+42,000', '{0:>+07,}', 42000)     # '0+42000'
-        # test('4,398,046,511,104', '{0:,}', 1 << 42)
-        # test('1,024.03', '{0:,}', 1024.03)
+
+        # thousands separator
+        test('+42,000', '{0:>+07,}', 42000)
+        test('4,398,046,511,104', '{0:,}', 1 << 42)
+        test('1,024.03', '{0:,}', 1024.03)
+        test('-1,234,567.50', '{0:,.2f}', -1234567.5)
+        test('1.234567e+06', '{0:,e}', 1234567.)
+        test('999', '{0:,d}', 999)
+        test('00,001,234', '{0:010,}', 1234)
+        test('0,001,234', '{0:08,}', 1234)
+        test('00,001,234', '{0:0=10,}', 1234)
+        test('000001,234', '{0:0>10,}', 1234)
+        test('1,23400000', '{0:0<10,}', 1234)
+        test('-0,001,234.50', '{0:012,.2f}', -1234.5)
+        test('+0,001,234', '{0:+010,}', 1234)
+        test(' 0,001,234', '{0: 09,}', 1234)
+        test('0,000', '{0:05,}', 0)
+        test('   1,234', '{0:8,}', 1234)
+        assert_raises(ValueError, '{0:,}', 'abc')
+        assert_raises(ValueError, '{0:,s}', 'abc')
+        assert_raises(ValueError, '{0:,n}', 1234)
+        assert_raises(ValueError, '{0:,x}', 1234)
 
         assert_raises(ValueError, '{0:>+07K}', 42.)
         assert_raises(ValueError, '{0:>07s}', .42)
@@ -481,24 +741,18 @@ if has_object_format:
         """
 
         # Monkey patch the _format_field to skip builtin method __format__
-        def _format_field(value, parts, conv, spec, want_bytes=False):
-            for k, part, _ in parts:
-                if k:
-                    if part.isdigit():
-                        value = value[int(part)]
-                    else:
-                        value = value[part]
-                else:
-                    value = getattr(value, part)
+        def _format_field(value, getter, conv, spec, want_bytes=False):
+            if getter is not None:
+                value = getter(value)
             if conv:
                 value = ((conv == 'r') and '%r' or '%s') % (value,)
             format_value = getattr(value, '__format__', None)
             if format_value and (hasattr(value, 'strftime') or
                     not isinstance(format_value, builtin_function_or_method)):
-                value = format_value(spec)
+                value = format_value(spec.format_spec)
             else:
                 # Skip the __format__ method for builtin types
-                value = _strformat(value, spec)
+                value = _emulate_format(value, spec)
             if want_bytes and isinstance(value, unicode):
                 return str(value)
             return value
@@ -608,10 +862,531 @@ class UnicodeFormatterTest(BaseFormatterTest):
             self.assertEqual("%s" % s, u('__unicode__ overridden'))
 
 
+class TemplateCacheTest(unittest.TestCase):
+
+    def test_lru(self):
+        from stringformat import _TemplateCache
+        cache = _TemplateCache(2)
+        a = cache.get('{0}a')
+        self.assertTrue(cache.get('{0}a') is a)
+        self.assertEqual(a.format(1), '1a')
+        cache.get('{0}b')
+        cache.get('{0}a')
+        # '{0}b' is the least recently used
+        cache.get('{0}c')
+        self.assertEqual(len(cache), 2)
+        self.assertEqual((cache.hits, cache.misses, cache.evictions),
+                         (2, 3, 1))
+        self.assertTrue(cache.get('{0}a') is a)
+        self.assertEqual(cache.misses, 3)
+        cache.get('{0}b')
+        self.assertEqual(cache.misses, 4)
+
+    def test_key_type(self):
+        from stringformat import _TemplateCache
+        cache = _TemplateCache()
+        self.assertEqual(type(cache.get(u('{0}')).format('x')), unicode)
+        self.assertEqual(type(cache.get('{0}').format('x')), str)
+
+    def test_resize(self):
+        from stringformat import _TemplateCache
+        cache = _TemplateCache(None)
+        for i in range(10):
+            cache.get('%d{0}' % i)
+        self.assertEqual(len(cache), 10)
+        cache.resize(3)
+        self.assertEqual((len(cache), cache.evictions), (3, 7))
+        cache.resize(0)
+        cache.get('{0}')
+        self.assertEqual(len(cache), 0)
+        cache.clear()
+        self.assertEqual((cache.hits, cache.misses, cache.evictions),
+                         (0, 0, 0))
+
+    def test_init(self):
+        from stringformat import init, _cache, DEFAULT_CACHE_SIZE
+        try:
+            init(cache_size=2000, compiled=True)
+            init()
+            self.assertEqual((_cache.maxsize, _cache.compiled), (2000, True))
+            init(cache_size=None)
+            self.assertEqual((_cache.maxsize, _cache.compiled), (None, True))
+        finally:
+            init(cache_size=DEFAULT_CACHE_SIZE, compiled=False)
+
+
+class BytesFormatterTest(unittest.TestCase):
+
+    def test_bytes(self):
+        from stringformat import BytesFormatter
+        cafe = u('caf%c') % 233
+        formatter = BytesFormatter(u('{0}:{1:>4}\r\n'), 'latin-1')
+        expected = (cafe + u(':  42\r\n')).encode('latin-1')
+        self.assertEqual(formatter.format(cafe, 42), expected)
+        self.assertEqual(list(formatter.format_many([(cafe, 42)])),
+                         [expected])
+        buffer = bytearray(u('>').encode('ascii'))
+        self.assertEqual(formatter.format_into(buffer, cafe, 42), 11)
+        self.assertEqual(bytes(buffer), u('>').encode('ascii') + expected)
+        blocks = []
+        self.assertEqual(formatter.write_many(blocks.append,
+                                              [(cafe, 42)] * 3, 20), 3)
+        self.assertEqual(blocks, [expected * 2, expected])
+
+        formatter = BytesFormatter(u('{0}').encode('ascii'), errors='replace')
+        self.assertEqual(formatter.format(cafe), u('caf?').encode('ascii'))
+        formatter = BytesFormatter(u('{0}'))
+        self.assertRaises(UnicodeError, formatter.format, cafe)
+
+
+class TemplateRegistryTest(unittest.TestCase):
+
+    def test_registry(self):
+        from stringformat import TemplateRegistry
+        registry = TemplateRegistry(['{0}a'], maxsize=2)
+        a = registry.get('{0}a')
+        self.assertTrue('{0}a' in registry)
+        self.assertTrue(a._func is not None)
+        self.assertEqual(registry.format('{0}a', 1), '1a')
+        self.assertEqual(type(registry.format(u('{0}a'), 1)), unicode)
+        registry.get('{0}c')
+        self.assertEqual(len(registry), 2)
+        # the registry is full
+        self.assertEqual(registry.format('{0}b', 1), '1b')
+        self.assertFalse('{0}b' in registry)
+        self.assertTrue(registry.get('{0}b')._func is None)
+        self.assertTrue(registry.add(f('{0}a')) is a)
+        registry.clear()
+        self.assertEqual(registry.templates(), [])
+
+    def test_threads(self):
+        import threading
+        from stringformat import TemplateRegistry
+        registry = TemplateRegistry()
+        formats = ['{0}-%d-{1[x]:>{2}}' % i for i in range(50)]
+        errors = []
+        found = {}
+
+        def worker(seed):
+            try:
+                for n in range(1000):
+                    fmt = formats[(n * seed) % len(formats)]
+                    template = registry.get(fmt)
+                    found.setdefault(fmt, template)
+                    if found[fmt] is not template:
+                        errors.append('%r registered twice' % fmt)
+                    rv = template.format(n, {'x': seed}, 3)
+                    if rv != fmt.format(n, {'x': seed}, 3):
+                        errors.append(rv)
+            except Exception:
+                errors.append(repr_exc())
+        threads = [threading.Thread(target=worker, args=(seed,))
+                   for seed in range(1, 17)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(registry), len(formats))
+
+
+class InternTemplateTest(unittest.TestCase):
+
+    def test_intern(self):
+        from stringformat import intern_template, intern_clear
+        a = intern_template('{0.x[1]:>{1}}, {n!r}')
+        self.assertTrue(intern_template('{0.x[1]:>{1}}, {n!r}') is a)
+        b = intern_template('{0.x[1]:>{1}}, {n!r}!')
+        self.assertTrue(a._slots[1] is b._slots[1])
+        self.assertTrue(a._tree is b._tree)
+        self.assertTrue(a._nested is b._nested)
+        self.assertFalse(a._chunks is b._chunks)
+        intern_template('{0}, {n!r}')
+        self.assertEqual(type(intern_template(u('{0}, {n!r}'))._slots[1]),
+                         unicode)
+
+        class X(object):
+            x = 'abc'
+        self.assertEqual(b.format(X(), 3, n=4), '  b, 4!')
+        self.assertEqual(b.compile().format(X(), 3, n=4), '  b, 4!')
+        intern_clear()
+        self.assertFalse(intern_template('{0.x[1]:>{1}}, {n!r}') is a)
+
+    def test_memory_report(self):
+        from stringformat import memory_report
+        templates = ['{0:>8} message%d from {user.name}' % i
+                     for i in range(100)]
+        report = memory_report(templates + templates)
+        self.assertEqual(report['count'], 200)
+        self.assertEqual(report['unique'], 100)
+        self.assertTrue(0 < report['compact'] < report['plain'])
+
+
+class LoggingTest(unittest.TestCase):
+
+    def setUp(self):
+        import logging
+        self.records = records = []
+
+        class Handler(logging.Handler):
+            def emit(self, record):
+                records.append(self.format(record))
+        self.handler = Handler()
+        self.logger = logging.getLogger('stringformat.test')
+        self.logger.addHandler(self.handler)
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+
+    def test_brace_message(self):
+        from stringformat import BraceMessage
+        calls = []
+
+        class Value(object):
+            def __str__(self):
+                calls.append(self)
+                return 'value'
+        self.logger.debug(BraceMessage('{0!s} {x}', Value(), x=1))
+        self.assertEqual((self.records, calls), ([], []))
+        message = BraceMessage('{0!s} {x}', Value(), x=1)
+        self.logger.info(message)
+        self.assertEqual(self.records, ['value 1'])
+        self.assertEqual(str(message), 'value 1')
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(message.render(), 'value 1')
+        self.assertEqual(repr(message), "<BraceMessage 'value 1'>")
+        self.assertEqual(type(BraceMessage(u('{0}'), 1).render()), unicode)
+
+    def test_brace_formatter(self):
+        from stringformat import BraceFormatter, _cache
+        # the messages of the other libraries use the '%' style
+        self.handler.setFormatter(BraceFormatter('{levelname}|{message}'))
+        self.logger.info('payload %s {"a": 1}', 'x')
+        self.logger.info('set %r is {0!x}', 'y')
+        self.logger.info('%s: {}', 'name')
+        self.assertEqual(self.records, ['INFO|payload x {"a": 1}',
+                                        "INFO|set 'y' is {0!x}",
+                                        'INFO|name: {}'])
+        self.assertFalse('%s: {}' in [template.format_string
+                                      for template in _cache.templates()])
+        del self.records[:]
+        self.handler.setFormatter(BraceFormatter('{levelname:>8}|{message}',
+                                                 brace_messages=True))
+        self.logger.info('{0} and {1:.1f}', 'a', 2)
+        self.logger.info('{x[y]}', {'x': {'y': 'z'}})
+        self.logger.info('{0[x]}', {'x': 'z'})
+        self.logger.info('%d%%', 100)
+        self.logger.info('{0}')
+        self.assertEqual(self.records, ['    INFO|a and 2.0', '    INFO|z',
+                                        '    INFO|z', '    INFO|100%',
+                                        '    INFO|{0}'])
+        del self.records[:]
+        formatter = BraceFormatter('{asctime} {message}', '%Y',
+                                   brace_messages=True)
+        self.assertTrue(formatter.usesTime())
+        self.handler.setFormatter(formatter)
+        try:
+            1 / 0
+        except ZeroDivisionError:
+            self.logger.exception('{0}', 'error')
+        lines = self.records[0].splitlines()
+        self.assertTrue(lines[0].endswith(' error'))
+        self.assertTrue(lines[0][:4].isdigit())
+        self.assertTrue(lines[-1].startswith('ZeroDivisionError'))
+        self.assertRaises(ValueError, BraceFormatter, '{message}', None, '$')
+
+    def test_dict_config(self):
+        import logging.config
+        from stringformat import BraceFormatter
+        handler = self.handler
+        logging.config.dictConfig({
+            'version': 1,
+            'disable_existing_loggers': False,
+            'formatters': {'brace': {'class': 'stringformat.BraceFormatter',
+                                     'format': '{levelname}|{message}'}},
+            'handlers': {'test': {'()': lambda: handler,
+                                  'formatter': 'brace'}},
+        })
+        if not isinstance(handler.formatter, BraceFormatter):
+            # Python 2 ignores the class of the formatters
+            return
+        self.assertFalse(handler.formatter.brace_messages)
+        self.logger.info('other lib %s {x}', 'arg')
+        self.assertEqual(self.records, ['INFO|other lib arg {x}'])
+
+
+class ProfilingTest(unittest.TestCase):
+
+    def tearDown(self):
+        import stringformat
+        stringformat.disable_profiling()
+        stringformat.profile_clear()
+
+    def test_profiling(self):
+        import stringformat
+        format_method = f.__dict__['format']
+        stringformat.enable_profiling()
+        stringformat.enable_profiling()
+        self.assertFalse(f.__dict__['format'] is format_method)
+        a, b = f('{0:>3}'), f('{0}{1}').compile()
+        for i in range(5):
+            self.assertEqual(a.format(i), '  %d' % i)
+        self.assertEqual(b.format(1, 2), '12')
+        self.assertRaises(KeyError, b.format, 1)
+        self.assertRaises(ValueError, f, '{0!x}')
+        stats = stringformat.profile_stats(sort='calls')
+        self.assertEqual([(s['template'], s['calls'], s['parses'],
+                           s['failures']) for s in stats],
+                         [('{0:>3}', 5, 1, 0), ('{0}{1}', 2, 1, 1),
+                          ('{0!x}', 0, 1, 1)])
+        for s in stats:
+            self.assertTrue(s['parse_time'] > 0)
+            self.assertTrue(s['format_time'] >= 0)
+        self.assertEqual(len(stringformat.profile_stats(2)), 2)
+
+        stringformat.disable_profiling()
+        self.assertTrue(f.__dict__['format'] is format_method)
+        a.format(1)
+        self.assertEqual(stringformat.profile_stats(sort='calls')[0]['calls'],
+                         5)
+        stringformat.profile_clear()
+        self.assertEqual(stringformat.profile_stats(), [])
+
+    def test_profiling_lazy(self):
+        import stringformat
+        stringformat.enable_profiling()
+        template = f('{0}-{1}', lazy=True)
+        # not parsed yet
+        self.assertEqual(stringformat.profile_stats(), [])
+        self.assertEqual(template.format(1, 2), '1-2')
+        self.assertEqual(template.format(3, 4), '3-4')
+        self.assertRaises(ValueError, f('{0!x}', lazy=True).format, 1)
+        stats = stringformat.profile_stats(sort='calls')
+        self.assertEqual([(s['template'], s['calls'], s['parses'],
+                           s['failures']) for s in stats],
+                         [('{0}-{1}', 2, 1, 0), ('{0!x}', 0, 1, 1)])
+        self.assertTrue(stats[0]['parse_time'] > 0)
+
+
+class SaveTemplatesTest(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        fd, self.filename = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def test_roundtrip(self):
+        import stringformat
+        templates = ['a{0:{1}}b%{x!r}{{', u('{} {}'), '',
+                     '{0.real:>{w}.{p}} {0.real:>{w}.{p}} %%']
+        stringformat.save_templates(self.filename, templates)
+        stringformat.cache_clear()
+        loaded = stringformat.load_templates(self.filename)
+        self.assertEqual(loaded, templates)
+        self.assertEqual(stringformat.cache_info()['currsize'], 4)
+        self.assertEqual(loaded[0].format(42, '>4', x='x'), "a  42b%'x'{")
+        self.assertEqual(loaded[1].format(1, 2), u('1 2'))
+        self.assertEqual(loaded[2].format(), '')
+        self.assertEqual(loaded[3].format(1.5, w=5, p=2),
+                         '  1.5   1.5 %%')
+        for template in loaded:
+            for slot in template._slots:
+                if not isinstance(slot, tuple):
+                    self.assertEqual(type(slot), type(template.format_string))
+        stringformat.cache_clear()
+
+        # save the content of the cache
+        stringformat._cache.get('{0}')
+        stringformat.save_templates(self.filename)
+        stringformat.cache_clear()
+        self.assertEqual(stringformat.load_templates(self.filename), ['{0}'])
+        stringformat.cache_clear()
+
+    def test_pickle(self):
+        import pickle
+        for fmt in ['a{0:{1}}b%{x!r}{{', u('{} {}'), '',
+                    '{0.real:>{w}.{p}} {0.real:>{w}.{p}} %%']:
+            for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+                for template in f(fmt), f(fmt).compile():
+                    loaded = pickle.loads(pickle.dumps(template, protocol))
+                    self.assertEqual(loaded, fmt)
+                    self.assertEqual(loaded._func is None,
+                                     template._func is None)
+                    args = (4.5, '>3')
+                    kwargs = dict(x='y', w=5, p=2)
+                    self.assertEqual(loaded.format(*args, **kwargs),
+                                     template.format(*args, **kwargs))
+
+    def test_version(self):
+        import marshal
+        import stringformat
+        fp = open(self.filename, 'wb')
+        marshal.dump((('stringformat-templates', 0, (2, 0)), []), fp)
+        fp.close()
+        self.assertEqual(stringformat.load_templates(self.filename), [])
+        fp = open(self.filename, 'wb')
+        fp.write('garbage'.encode('ascii'))
+        fp.close()
+        self.assertEqual(stringformat.load_templates(self.filename), [])
+
+    def test_precompile(self):
+        import stringformat
+        stringformat.cache_clear()
+        templates = stringformat.precompile(['{0}', f('{1}')])
+        self.assertEqual(templates, ['{0}', '{1}'])
+        self.assertEqual(stringformat.cache_info()['currsize'], 2)
+        self.assertRaises(ValueError, stringformat.precompile, ['{0!x}'])
+        stringformat.cache_clear()
+
+    def test_main(self):
+        import shutil
+        import tempfile
+        import stringformat
+        source = ("import stringformat\n"
+                  "x = '{0} {1:>5}'.format(1, 2)\n"
+                  "y = stringformat.FormattableString('{name!x}')\n"
+                  "z = ('a' '{}').format(3) + '{0[}'.format(4)\n"
+                  "w = name.format('{0}')\n")
+        self.assertEqual(stringformat._scan_source(source),
+                         [(2, '{0} {1:>5}'), (3, '{name!x}'), (4, 'a{}'),
+                          (4, '{0[}')])
+        class Output(list):
+            write = list.append
+        directory = tempfile.mkdtemp()
+        lines = Output()
+        stdout = sys.stdout
+        try:
+            fp = open(os.path.join(directory, 'module.py'), 'w')
+            fp.write(source)
+            fp.close()
+            fp = open(os.path.join(directory, 'invalid.py'), 'w')
+            fp.write('def (\n')
+            fp.close()
+            sys.stdout = lines
+            rv = stringformat.main(['-o', self.filename, directory])
+        finally:
+            sys.stdout = stdout
+            shutil.rmtree(directory)
+        self.assertEqual(rv, 1)
+        output = ''.join(lines).splitlines()
+        self.assertEqual(len(output), 4)
+        self.assertTrue(output[0].endswith('cannot parse: invalid syntax '
+                                           '(invalid.py, line 1)'))
+        self.assertTrue(output[1].endswith("module.py:3: Unknown conversion "
+                                           "specifier x: '{name!x}'"))
+        self.assertEqual(output[-1], '2 templates in 2 files, 2 errors')
+        loaded = stringformat.load_templates(self.filename)
+        self.assertEqual(loaded, ['{0} {1:>5}', 'a{}'])
+        stringformat.cache_clear()
+
+
+class ParserTest(unittest.TestCase):
+
+    def test_split_field_name(self):
+        from stringformat import _split_field_name
+        from stringformat_lite import _field_part_re
+        for literal in ['', '0', 'abc', '.', '[', '0.', '0[', '0]', '0..a',
+                        '0.a[1].b', '0[a.b]', '0[a', '0[a]b.c', '0[a]]',
+                        ' ] [ . [ ]', '[1][2]', '.a.b', 'a]b[c[d].e]f.g[h.i]',
+                        '0[0](10)', '0[{1}]', '[]', '0.[]']:
+            self.assertEqual(_split_field_name(literal),
+                             _field_part_re.findall(literal))
+
+    def test_parse(self):
+        from stringformat import _Parser
+        parser = _Parser()
+        chunks = parser.parse('{{%{0.a[1]:>{w}}}}{0.a[1]:>{w}}x')
+        slots = parser.slots
+        fields = [value for value in slots if isinstance(value, tuple)]
+        self.assertEqual([name for (name, item) in fields], ['w', '0'])
+        item = fields[1][1]
+        parts, getter, conv, spec, slot = item
+        self.assertEqual((parts, conv), ((('', 'a'), ('[', 1)), ''))
+        self.assertEqual([slots[i] for i in spec], ['>', fields[0]])
+        self.assertEqual([slots[i] for i in chunks],
+                         ['{%', ('0', item), '}', ('0', item), 'x'])
+
+    def test_introspection(self):
+        template = f('{{%{0.a[1]:>{w}}}}{0.a[1]:>{w}}{2!r:{3}.{p}f}x')
+        self.assertEqual(template.fields(), [
+            ('w', (), None, ''),
+            ('0', (('.', 'a'), ('[', 1)), None, '>{w}'),
+            ('3', (), None, ''),
+            ('p', (), None, ''),
+            ('2', (), 'r', '{3}.{p}f')])
+        self.assertEqual(template.required_args(), (4, ['p', 'w']))
+        self.assertEqual(template.literal_length(), 4)
+        self.assertEqual(template.min_length(), 4)
+        self.assertEqual(f('{0:>12}{1:<30}{2:^8.2f}|').min_length(), 51)
+        self.assertEqual(f('{0:%Y-%m-%d}').min_length(), 0)
+        self.assertEqual(f('').fields(), [])
+        self.assertEqual(f('a').required_args(), (0, []))
+        self.assertEqual(f('{01}{1}').required_args(), (2, ['01']))
+        name = '\xb2'
+        if not python_3:
+            name = name.decode('latin-1')
+        self.assertEqual(f('{' + name + '}').required_args(), (0, [name]))
+
+
+class FormatSpecTest(unittest.TestCase):
+
+    def test_parse_spec(self):
+        from stringformat import _parse_spec
+        spec = _parse_spec('*^+#012,.3f')
+        self.assertEqual((spec.fill, spec.align, spec.sign, spec.prefix,
+                          spec.zero, spec.width, spec.comma, spec.precision,
+                          spec.type),
+                         ('*', '^', '+', '#', True, 12, ',', '.3', 'f'))
+        self.assertTrue(_parse_spec('*^+#012,.3f') is spec)
+        spec = _parse_spec('>7')
+        self.assertEqual((spec.fill, spec.align, spec.width, spec.type),
+                         (' ', '>', 7, ''))
+        # not a standard specification, but valid for __format__
+        spec = _parse_spec('%Y-%m-%d')
+        self.assertEqual((spec.format_spec, spec.width), ('%Y-%m-%d', None))
+        self.assertRaises(ValueError, _strformat, 42, spec)
+        self.assertFalse(spec.native)
+        # a non-ASCII fill character
+        spec = _parse_spec(u('%c^7') % 233)
+        self.assertEqual((spec.fill, spec.align, spec.width),
+                         (u('%c') % 233, '^', 7))
+        self.assertEqual(f(u('{0:%c^7}') % 233).format(u('ab')),
+                         (u('%c') % 233) * 2 + u('ab') + (u('%c') % 233) * 3)
+
+    def test_native(self):
+        from stringformat import _native_format
+        if _native_format is None:      # Python < 2.6
+            return
+        spec = _parse_spec('*^+12.3e')
+        self.assertTrue(spec.native)
+        self.assertEqual(_strformat(1234.5, spec), '*+1.234e+03*')
+        self.assertEqual(_strformat(1234.5, '.3'), '1.23e+03')
+
+        class Number(float):
+            pass
+        # not a builtin type
+        self.assertEqual(_strformat(Number(1234.5), spec), '*+1.234e+03*')
+        self.assertEqual(_strformat(True, '>5'), ' True')
+
+
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(StringFormatterTest))
     suite.addTest(unittest.makeSuite(UnicodeFormatterTest))
+    suite.addTest(unittest.makeSuite(TemplateCacheTest))
+    suite.addTest(unittest.makeSuite(ParserTest))
+    suite.addTest(unittest.makeSuite(FormatSpecTest))
+    suite.addTest(unittest.makeSuite(BytesFormatterTest))
+    suite.addTest(unittest.makeSuite(TemplateRegistryTest))
+    suite.addTest(unittest.makeSuite(InternTemplateTest))
+    suite.addTest(unittest.makeSuite(LoggingTest))
+    suite.addTest(unittest.makeSuite(ProfilingTest))
+    suite.addTest(unittest.makeSuite(SaveTemplatesTest))
     return suite
 
 if __name__ == "__main__":